@@ -1,92 +1,279 @@
 # annotator.py
 import os
+import sys
 import uuid
-import subprocess
-import boto3
+import time
 import json
+import shutil
+from botocore.exceptions import ClientError
 
 # Import the ConfigParser
 from configparser import ConfigParser
 
+from lease import LeaseManager
+from engine import WarmPool, SubprocessLauncher
+from input_cache import InputCache
+import stream_ingest
+
+# Shared AWS clients (gas/common)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import aws_clients
+
 config = ConfigParser()
-config.read("/home/ec2-user/mpcs-cc/gas/ann/ann_config.ini")
+# GAS_ANN_CONFIG points at another config, e.g. for util/bench/bench.py
+config.read(os.environ.get('GAS_ANN_CONFIG', "/home/ec2-user/mpcs-cc/gas/ann/ann_config.ini"))
 
 
 
 # Connect to SQS and get the message queue
-sqs = boto3.client('sqs')
-dynamo = boto3.resource('dynamodb')
+sqs = aws_clients.client('sqs', region_name=config.get('aws', 'AwsRegionName'))
+dynamo = aws_clients.resource('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
 # Replace hardcoded value
 table = dynamo.Table(config.get('aws', 'DynamoDbTableName'))
 
 # Replace hardcoded value
 queue_url = config.get('aws', 'QueueUrl')
 
+# Worker pool settings; every slot runs one annotation job at a time
+MAX_CONCURRENT_JOBS = config.getint('ann', 'MaxConcurrentJobs', fallback=0) or os.cpu_count() or 1
+BUSY_POLL_SECONDS = config.getfloat('ann', 'BusyPollSeconds', fallback=2)
+# Seconds before retrying a request whose job item hasn't been written yet,
+# and how many times it is received before it is dropped as orphaned
+MISSING_JOB_RETRY_SECONDS = config.getint('ann', 'MissingJobRetrySeconds', fallback=5)
+MISSING_JOB_MAX_ATTEMPTS = config.getint('ann', 'MissingJobMaxAttempts', fallback=12)
+# Times a job is tried (by any node) before it is marked FAILED
+MAX_JOB_ATTEMPTS = config.getint('ann', 'MaxJobAttempts', fallback=3)
+# SQS returns at most 10 messages per receive
+SQS_MAX_MESSAGES = 10
+
+# "pool" keeps one warm run.py worker per slot; "subprocess" starts a new
+# Python interpreter for every job
+EXECUTION_MODE = config.get('ann', 'ExecutionMode', fallback='pool')
+RUN_SCRIPT = config.get('ann', 'RunScript', fallback="/home/ec2-user/mpcs-cc/gas/ann/anntools/run.py")
+launcher = None
+
+# Inputs are cached on local disk by S3 ETag/size; a budget of 0 disables it
+INPUT_CACHE_MAX_BYTES = config.getint('ann', 'InputCacheMaxBytes', fallback=0)
+input_cache = None
+if INPUT_CACHE_MAX_BYTES > 0:
+    input_cache = InputCache(
+        config.get('ann', 'InputCacheDir', fallback=os.path.join(os.getcwd(), 'cache')),
+        INPUT_CACHE_MAX_BYTES)
+
+# Inputs of at least this size are streamed into AnnTools while they
+# download; 0 always downloads first
+STREAM_INGEST_BYTES = config.getint('ann', 'StreamIngestBytes', fallback=0)
+STREAM_PART_BYTES = config.getint('ann', 'StreamPartBytes', fallback=8 * 1024 * 1024)
+STREAM_WORKERS = config.getint('ann', 'StreamWorkers', fallback=4)
+
+# Messages stay invisible while their job runs and are deleted only once
+# run.py has marked the job COMPLETED
+leases = LeaseManager(
+    sqs, queue_url,
+    visibility_timeout=config.getint('ann', 'VisibilityTimeout', fallback=300),
+    renew_interval=config.getint('ann', 'LeaseRenewSeconds', fallback=60)
+)
+
+
+def discard_job_files(job_id):
+    """Remove what a failed job left on disk (its folder, with the input
+    or the named pipe, and any spool file) so a redelivery starts clean."""
+    job_folder = os.path.join(os.getcwd(), 'jobs', job_id)
+    shutil.rmtree(job_folder, ignore_errors=True)
+    for path in (job_folder + '.spool', job_folder + '.spool.part'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_UpdateItem.html
+def retry_or_fail(job_id, attempts):
+    """A try of job_id failed. Leave its message to be redelivered, or after
+    MAX_JOB_ATTEMPTS tries mark the job FAILED and delete the message so a
+    bad input doesn't keep being annotated."""
+    discard_job_files(job_id)
+    if attempts < MAX_JOB_ATTEMPTS:
+        leases.abandon(job_id)
+        return
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET job_status = :failed, complete_time = :complete_time REMOVE job_progress",
+            ConditionExpression="job_status = :running",
+            ExpressionAttributeValues={':failed': 'FAILED', ':running': 'RUNNING',
+                                       ':complete_time': int(time.time())}
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            # Try again when the message comes back
+            print(f"Error marking job {job_id} as failed: {e}")
+            leases.abandon(job_id)
+            return
+    print(f"Job {job_id} failed {attempts} times; marked as FAILED")
+    leases.release(job_id)
+
+
 #https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_GetItem.html
-#https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
-#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
 #https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
 #https://docs.aws.amazon.com/sns/latest/dg/sns-sqs-as-subscriber.html
-# Poll the message queue in a loop
-while True:
-    # Attempt to read a message from the queue (using long polling)
-    response = sqs.receive_message(
-        QueueUrl=queue_url,
-        AttributeNames=['All'],
-        MaxNumberOfMessages=1,
-        MessageAttributeNames=['All'],
-        WaitTimeSeconds=5
-    )
-
-    # If a message is read, extract job parameters from the message body
-    if 'Messages' in response:
-        message = response['Messages'][0]
-        receipt_handle = message['ReceiptHandle']
-        message_body = json.loads(message['Body'])
-
-        # Extract the actual content from the SNS notification
-        sns_message = json.loads(message_body['Message'])
-
-        s3_bucket = sns_message.get('s3_inputs_bucket')
-        s3_key = sns_message.get('s3_key_input_file')
-        job_id = sns_message.get('job_id')
-        email = sns_message.get('email')
-
-        # Check if required keys are present in the message body
-        if not s3_bucket or not s3_key or not job_id:
-            print("Error: Missing required keys in the message body.")
-            continue
-        #print(s3_key)
+def handle_message(message, running):
+    """Download the job input and launch the annotator for one SQS message.
+    Returns (job_id, process, attempts) if a job was started, otherwise None.
+    """
+    receipt_handle = message['ReceiptHandle']
+    attempts = int(message.get('Attributes', {}).get('ApproximateReceiveCount', 1))
+    message_body = json.loads(message['Body'])
+
+    # Extract the actual content from the SNS notification
+    sns_message = json.loads(message_body['Message'])
+
+    s3_bucket = sns_message.get('s3_inputs_bucket')
+    s3_key = sns_message.get('s3_key_input_file')
+    job_id = sns_message.get('job_id')
+    email = sns_message.get('email')
+
+    # Check if required keys are present in the message body
+    if not s3_bucket or not s3_key or not job_id:
+        print("Error: Missing required keys in the message body.")
+        return None
+    #print(s3_key)
 
-        # Get the input file S3 object and copy it to a local file
+    if job_id in running:
+        # Redelivered while it still runs here (e.g. a lease extension
+        # failed); only the newest receipt handle can delete the message
+        print(f"Job {job_id} is already running on this node; keeping its new message")
+        leases.acquire(job_id, receipt_handle)
+        return None
+
+    # Hold the message for as long as the job runs; a redelivered message
+    # (e.g. after a node died) finds the job RUNNING and runs it again
+    leases.acquire(job_id, receipt_handle)
+    try:
+        table.update_item(
+        Key={'job_id': job_id},
+        UpdateExpression="SET job_status = :status",
+        ConditionExpression="job_status IN (:pending, :running)",
+        ExpressionAttributeValues={':status': 'RUNNING', ':pending': 'PENDING', ':running': 'RUNNING'},
+        ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException' and 'Item' not in e.response \
+                and attempts >= MISSING_JOB_MAX_ATTEMPTS:
+            # The job was never saved (e.g. the web app failed after
+            # publishing the request); nothing will ever run it
+            print(f"Job {job_id} is still not in the database after {attempts} attempts; deleting message")
+            leases.release(job_id)
+        elif e.response['Error']['Code'] == 'ConditionalCheckFailedException' and 'Item' not in e.response:
+            # The web app publishes the request while it writes the job
+            # item, so the item may not be there yet; try again shortly
+            print(f"Job {job_id} is not in the database yet; retrying in {MISSING_JOB_RETRY_SECONDS} seconds")
+            leases.abandon(job_id, retry_after=MISSING_JOB_RETRY_SECONDS)
+        elif e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            # Job already completed by an earlier delivery; just drop the message
+            print(f"Job {job_id} is already complete; deleting duplicate message")
+            leases.release(job_id)
+        else:
+            print(f"Error updating job {job_id}: {e}")
+            leases.abandon(job_id)
+        return None
+
+    # Get the input file S3 object and copy it to a local file
+    try:
         job_folder = os.path.join(os.getcwd(), 'jobs', job_id)
         if not os.path.exists(job_folder):
             os.makedirs(job_folder)
 
         input_file = os.path.join(job_folder, os.path.basename(s3_key))
         # Replace hardcoded value
-        s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
-        s3.download_file(s3_bucket, s3_key, input_file)
+        s3 = aws_clients.client('s3', region_name=config.get('aws', 'AwsRegionName'))
+        spool_file = None
+        head = s3.head_object(Bucket=s3_bucket, Key=s3_key) if STREAM_INGEST_BYTES > 0 else None
+        if head and head['ContentLength'] >= STREAM_INGEST_BYTES:
+            # Overlap download and annotation; the spool file lives outside
+            # the job folder and replaces the pipe once the job has read it
+            spool_file = job_folder + '.spool'
+            stream_ingest.start_stream(s3, s3_bucket, s3_key, head, input_file, spool_file,
+                STREAM_PART_BYTES, STREAM_WORKERS)
+        elif input_cache:
+            input_cache.fetch(s3, s3_bucket, s3_key, input_file)
+            print(f"Input cache: {input_cache.stats()}")
+        else:
+            s3.download_file(s3_bucket, s3_key, input_file)
 
-        # Launch annotation job as a background process
-        try:
-            script_path = os.path.join(os.getcwd(), 'anntools', 'run.py')
-            print(email)
-            job = subprocess.Popen(['python', "/home/ec2-user/mpcs-cc/gas/ann/anntools/run.py", input_file, job_id,email])
+        # Launch annotation job in the background
+        print(email)
+        job = launcher.submit(input_file, job_id, email, spool_file)
+    except Exception as e:
+        print({str(e)})
+        retry_or_fail(job_id, attempts)
+        return None
 
-            table.update_item(
-            Key={'job_id': job_id},
-            UpdateExpression="SET job_status = :status",
-            ConditionExpression="job_status = :pending",
-            ExpressionAttributeValues={':status': 'RUNNING', ':pending': 'PENDING'}
-            )
-
-            # Delete the message from the queue, if job was successfully submitted
-            sqs.delete_message(
-                QueueUrl=queue_url,
-                ReceiptHandle=receipt_handle
-            )
-        except Exception as e:
-            print({str(e)})
+    return job_id, job, attempts
+
+
+def reap_finished_jobs(running):
+    """Remove finished annotation processes from the running table so their
+    slots can be reused. run.py exits with 0 only after the job has been
+    recorded as COMPLETED, so only then is the message deleted; failed jobs
+    are redelivered when their lease lapses, up to MAX_JOB_ATTEMPTS times.
+    """
+    for job_id, (job, attempts) in list(running.items()):
+        return_code = job.poll()
+        if return_code is None:
+            continue
+        del running[job_id]
+        if return_code != 0:
+            print(f"Annotation job {job_id} exited with code {return_code}")
+            retry_or_fail(job_id, attempts)
+        else:
+            print(f"Annotation job {job_id} finished")
+            leases.release(job_id)
+
+
+#https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
+#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
+def main():
+    global launcher
+    print(f"Starting annotator with {MAX_CONCURRENT_JOBS} job slots ({EXECUTION_MODE} mode)")
+    # Fork the warm workers before any other thread is running
+    if EXECUTION_MODE == 'pool':
+        launcher = WarmPool(MAX_CONCURRENT_JOBS, RUN_SCRIPT)
     else:
-        print("No messages in the queue.")
+        launcher = SubprocessLauncher(RUN_SCRIPT)
+    leases.start()
+
+    # job_id -> (annotation process, attempt) for every job occupying a slot
+    running = {}
+
+    # Poll the message queue in a loop
+    while True:
+        reap_finished_jobs(running)
+
+        # Stop polling while every slot is busy so messages stay in the
+        # queue for other nodes instead of waiting here
+        free_slots = MAX_CONCURRENT_JOBS - len(running)
+        if free_slots <= 0:
+            time.sleep(BUSY_POLL_SECONDS)
+            continue
+
+        # Attempt to read only as many messages as there are free slots (using long polling)
+        response = sqs.receive_message(
+            QueueUrl=queue_url,
+            AttributeNames=['All'],
+            MaxNumberOfMessages=min(free_slots, SQS_MAX_MESSAGES),
+            MessageAttributeNames=['All'],
+            WaitTimeSeconds=5
+        )
+
+        # If messages are read, extract job parameters from each message body
+        if 'Messages' in response:
+            for message in response['Messages']:
+                started = handle_message(message, running)
+                if started:
+                    job_id, job, attempts = started
+                    running[job_id] = (job, attempts)
+        else:
+            print("No messages in the queue.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+# engine.py
+#
+# Runs annotation jobs for annotator.py, either in a pool of warm worker
+# processes that import run.py (and with it AnnTools and the AWS clients)
+# once and then take jobs over a pipe, or as one run.py process per job.
+#
+# Both kinds of job handle answer poll() like subprocess.Popen: None while
+# the job runs, then 0 on success or a non-zero code on failure.
+#
+# The first workers are forked before the annotator starts any threads.
+# Workers that die later are replaced through a fork server started at the
+# same time, since forking the threaded annotator could copy a lock some
+# other thread holds into the child.
+#
+##
+import os
+import sys
+import time
+import subprocess
+import traceback
+import multiprocessing
+import multiprocessing.forkserver
+
+
+def _worker_main(conn, run_script):
+    # Import run.py once for the lifetime of the worker
+    started = time.time()
+    sys.path.insert(0, os.path.dirname(run_script))
+    import run
+    print(f"Warm worker {os.getpid()} ready in {time.time() - started:.2f} seconds")
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            break
+        if request is None:
+            break
+
+        (input_file, job_id, email, spool_file), dispatched_at = request
+        try:
+            run.run_job(input_file, job_id, email, dispatched_at=dispatched_at, spool_file=spool_file)
+            conn.send(0)
+        except Exception:
+            traceback.print_exc()
+            conn.send(1)
+
+
+class WarmWorker(object):
+    def __init__(self, context, run_script):
+        self.conn, child_conn = context.Pipe()
+        # Not a daemon, so a job is free to start processes of its own
+        self.process = context.Process(target=_worker_main, args=(child_conn, run_script), daemon=False)
+        self.process.start()
+        child_conn.close()
+
+
+class PoolJob(object):
+    def __init__(self, pool, worker):
+        self.pool = pool
+        self.worker = worker
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.pool._collect(self.worker)
+        return self.returncode
+
+
+class WarmPool(object):
+    def __init__(self, size, run_script):
+        self.run_script = run_script
+        self.context = multiprocessing.get_context('fork')
+        self.idle = [WarmWorker(self.context, run_script) for _ in range(size)]
+        self.replacement_context = multiprocessing.get_context('forkserver')
+        self.replacement_context.set_forkserver_preload(['engine'])
+        multiprocessing.forkserver.ensure_running()
+
+    def submit(self, input_file, job_id, email, spool_file=None):
+        while True:
+            worker = self.idle.pop()
+            if worker.process.is_alive():
+                try:
+                    worker.conn.send(((input_file, job_id, email, spool_file), time.time()))
+                    return PoolJob(self, worker)
+                except OSError:
+                    # Died since we looked; BrokenPipeError is an OSError
+                    pass
+            self._replace(worker)
+
+    def _replace(self, worker):
+        print(f"Warm worker {worker.process.pid} exited with code {worker.process.exitcode}; replacing it")
+        worker.conn.close()
+        worker.process.join(timeout=1)
+        self.idle.append(WarmWorker(self.replacement_context, self.run_script))
+
+    def _collect(self, worker):
+        """Return the exit code of the job running on worker, or None if it
+        is still running. Workers that died mid-job are replaced."""
+        if worker.conn.poll():
+            try:
+                return_code = worker.conn.recv()
+            except EOFError:
+                return_code = None
+            if return_code is not None:
+                self.idle.append(worker)
+                return return_code
+
+        if worker.process.is_alive():
+            return None
+
+        self._replace(worker)
+        return worker.process.exitcode or 1
+
+    def close(self):
+        for worker in self.idle:
+            worker.conn.send(None)
+            worker.process.join()
+
+
+class SubprocessLauncher(object):
+    def __init__(self, run_script):
+        self.run_script = run_script
+
+    def submit(self, input_file, job_id, email, spool_file=None):
+        env = dict(os.environ, GAS_DISPATCH_TIME=str(time.time()))
+        args = ['python', self.run_script, input_file, job_id, email]
+        if spool_file:
+            args.append(spool_file)
+        return subprocess.Popen(args, env=env)
+
+    def close(self):
+        pass
@@ -0,0 +1,40 @@
+# gzip_stream.py
+#
+# File-like wrapper that gzip-compresses another file as it is read, so a
+# result file can be compressed while it streams to S3 without writing a
+# compressed copy to disk first.
+#
+##
+import zlib
+
+# Size of the pieces read from the source file
+READ_SIZE = 1024 * 1024
+
+
+class GzipStream(object):
+    def __init__(self, source, level=6):
+        self.source = source
+        # wbits=31 produces a gzip header and trailer around the deflate data
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.buffer = bytearray()
+        self.finished = False
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            data = self.source.read(READ_SIZE)
+            if data:
+                self.buffer += self.compressor.compress(data)
+            else:
+                self.buffer += self.compressor.flush()
+                self.finished = True
+
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def readable(self):
+        return True
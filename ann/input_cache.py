@@ -0,0 +1,119 @@
+# input_cache.py
+#
+# On-disk cache of job input files on an annotator node. Entries are keyed
+# by the S3 object's ETag and size, kept under a byte budget with least
+# recently used eviction, and placed into job folders as hard links (or
+# reflinks/copies where linking is not possible) instead of downloading
+# the same input again.
+#
+##
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import threading
+
+# ioctl request that clones a file's extents on btrfs/xfs (linux/fs.h)
+FICLONE = 0x40049409
+
+
+class InputCache(object):
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        os.makedirs(self.root, exist_ok=True)
+
+    #https://docs.aws.amazon.com/AmazonS3/latest/API/API_HeadObject.html
+    def fetch(self, s3, bucket, key, dest):
+        """Place the content of s3://bucket/key at dest, downloading it only
+        if an identical object is not cached yet."""
+        head = s3.head_object(Bucket=bucket, Key=key)
+        etag = head['ETag'].strip('"')
+        size = head['ContentLength']
+        entry = os.path.join(self.root, hashlib.sha256(f'{etag}:{size}'.encode()).hexdigest())
+
+        with self.lock:
+            cached = os.path.exists(entry) and os.path.getsize(entry) == size
+            if cached:
+                # Mark the entry as recently used
+                os.utime(entry)
+                self.hits += 1
+                self.bytes_saved += size
+
+        if not cached:
+            partial = f'{entry}.{os.getpid()}.{threading.get_ident()}.part'
+            try:
+                # IfMatch makes sure the bytes we cache belong to this ETag
+                s3.download_file(bucket, key, partial, ExtraArgs={'IfMatch': etag})
+                os.replace(partial, entry)
+            finally:
+                if os.path.exists(partial):
+                    os.remove(partial)
+            with self.lock:
+                self.misses += 1
+                self.evict(keep=entry)
+
+        materialize(entry, dest)
+        self.write_stats()
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits its budget."""
+        entries = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.endswith('.part') or name == 'stats.json' or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            # Job folders holding a hard link keep their copy
+            os.remove(path)
+            total -= size
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0,
+                'bytes_saved': self.bytes_saved
+            }
+
+    def write_stats(self):
+        # Written next to the entries so the counters can be read from outside
+        stats_file = os.path.join(self.root, 'stats.json')
+        with open(stats_file + '.tmp', 'w') as f:
+            json.dump(self.stats(), f)
+        os.replace(stats_file + '.tmp', stats_file)
+
+
+def materialize(source, dest):
+    """Make dest a hard link to source, or a reflink or plain copy of it if
+    the two paths can't share an inode."""
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+        return
+    except OSError:
+        pass
+
+    with open(source, 'rb') as src, open(dest, 'wb') as dst:
+        try:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            return
+        except OSError:
+            pass
+        shutil.copyfileobj(src, dst, 1024 * 1024)
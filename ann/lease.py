@@ -0,0 +1,102 @@
+# lease.py
+#
+# Keeps SQS job request messages invisible while their annotation job
+# is still running, so a message is only deleted once the job has been
+# recorded as COMPLETED and is redelivered if this node dies.
+#
+##
+import time
+import threading
+
+
+#https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ChangeMessageVisibility.html
+#https://docs.aws.amazon.com/AWSSimpleQueueService/latest/SQSDeveloperGuide/sqs-visibility-timeout.html
+class LeaseManager(object):
+    def __init__(self, sqs, queue_url, visibility_timeout=300, renew_interval=60):
+        self.sqs = sqs
+        self.queue_url = queue_url
+        self.visibility_timeout = visibility_timeout
+        self.renew_interval = renew_interval
+        # job_id -> [receipt_handle, time of last extension]
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """Start the heartbeat thread that extends every held lease."""
+        self.thread = threading.Thread(target=self._heartbeat, name='sqs-lease-heartbeat', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def acquire(self, job_id, receipt_handle):
+        """Take over the visibility of a received message for job_id."""
+        with self.lock:
+            self.leases[job_id] = [receipt_handle, time.time()]
+        self._extend(job_id, receipt_handle)
+
+    def release(self, job_id):
+        """The job completed: delete its message so it is never redelivered."""
+        with self.lock:
+            lease = self.leases.pop(job_id, None)
+        if lease is None:
+            return
+        try:
+            self.sqs.delete_message(QueueUrl=self.queue_url, ReceiptHandle=lease[0])
+        except Exception as e:
+            print(f"Error deleting message for job {job_id}: {e}")
+
+    def abandon(self, job_id, retry_after=None):
+        """The job failed: stop extending the lease and leave the message in
+        the queue so it becomes visible again once the lease runs out, or
+        after retry_after seconds if given.
+        """
+        with self.lock:
+            lease = self.leases.pop(job_id, None)
+        if lease is None or retry_after is None:
+            return
+        try:
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=lease[0],
+                VisibilityTimeout=retry_after
+            )
+        except Exception as e:
+            print(f"Error shortening visibility for job {job_id}: {e}")
+
+    def held(self):
+        with self.lock:
+            return list(self.leases)
+
+    def renew_due(self):
+        """Extend every lease that has not been extended for renew_interval."""
+        now = time.time()
+        with self.lock:
+            due = [(job_id, lease[0]) for job_id, lease in self.leases.items()
+                   if now - lease[1] >= self.renew_interval]
+        for job_id, receipt_handle in due:
+            self._extend(job_id, receipt_handle)
+
+    def _extend(self, job_id, receipt_handle):
+        try:
+            self.sqs.change_message_visibility(
+                QueueUrl=self.queue_url,
+                ReceiptHandle=receipt_handle,
+                VisibilityTimeout=self.visibility_timeout
+            )
+        except Exception as e:
+            print(f"Error extending visibility for job {job_id}: {e}")
+            return
+        with self.lock:
+            if job_id in self.leases:
+                self.leases[job_id][1] = time.time()
+
+    def _heartbeat(self):
+        # Wake up often enough that no lease misses its renewal by much
+        wake_interval = max(1, min(self.renew_interval / 4, 10))
+        while not self.stopped.wait(wake_interval):
+            self.renew_due()
@@ -0,0 +1,127 @@
+# progress.py
+#
+# Publishes the progress of a running annotation job to its DynamoDB item
+# as job_progress: the records written to the annotated output so far and
+# the bytes of input read. A background thread samples both every few
+# seconds and writes only when they changed. Writes are conditional on the
+# job still being RUNNING, so a late sample can't touch a completed job.
+#
+##
+import os
+import time
+import threading
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+
+def input_position(path):
+    """Return how far this process has read into path, or None if it
+    doesn't have the file open (e.g. chunked jobs read it in child
+    processes, or the file isn't open yet)."""
+    path = os.path.realpath(path)
+    try:
+        fds = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    position = None
+    for fd in fds:
+        try:
+            if os.readlink(f'/proc/self/fd/{fd}') != path:
+                continue
+            with open(f'/proc/self/fdinfo/{fd}') as fdinfo:
+                for line in fdinfo:
+                    if line.startswith('pos:'):
+                        position = max(position or 0, int(line.split()[1]))
+        except (OSError, ValueError):
+            # The descriptor was closed while we looked at it
+            continue
+    return position
+
+
+class RecordCounter(object):
+    """Counts the data (non-header) lines of a VCF as it is written,
+    reading only what was appended since the last count."""
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        self.last_byte = b'\n'
+        self.records = 0
+
+    def count(self):
+        try:
+            output = open(self.path, 'rb')
+        except OSError:
+            return 0
+        with output:
+            output.seek(self.offset)
+            while True:
+                data = output.read(1024 * 1024)
+                if not data:
+                    break
+                # Lines are counted when they end, header lines when they start
+                headers = (self.last_byte + data).count(b'\n#')
+                self.records += data.count(b'\n') - headers
+                self.offset += len(data)
+                self.last_byte = data[-1:]
+        return max(0, self.records)
+
+
+class ProgressMonitor(object):
+    def __init__(self, job_id, input_file, output_file, table_name, region_name, interval=10):
+        self.job_id = job_id
+        self.input_file = input_file
+        self.counter = RecordCounter(output_file)
+        self.table_name = table_name
+        self.region_name = region_name
+        self.interval = interval
+        # A streamed input is a named pipe with no size
+        self.input_bytes = os.path.getsize(input_file) if os.path.isfile(input_file) else None
+        self.last = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name=f'progress-{self.job_id}', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def _run(self):
+        # Resources aren't thread-safe; use this thread's own
+        table = aws_clients.resource('dynamodb', region_name=self.region_name).Table(self.table_name)
+        while not self.stopped.wait(self.interval):
+            if not self.publish(table):
+                break
+
+    #https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+    def publish(self, table):
+        """Write the current progress if it changed; returns False once the
+        job is no longer RUNNING."""
+        sample = (self.counter.count(), input_position(self.input_file))
+        if sample == self.last:
+            return True
+        records, bytes_read = sample
+        progress = {'records': records, 'updated_time': int(time.time())}
+        if bytes_read is not None:
+            progress['bytes_read'] = bytes_read
+        if self.input_bytes is not None:
+            progress['input_bytes'] = self.input_bytes
+        try:
+            table.update_item(
+                Key={'job_id': self.job_id},
+                UpdateExpression="SET job_progress = :progress",
+                ConditionExpression="job_status = :running",
+                ExpressionAttributeValues={':progress': progress, ':running': 'RUNNING'}
+            )
+        except ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            # Progress is best effort; try again at the next sample
+            print(f"Error updating progress of job {self.job_id}: {e}")
+            return True
+        self.last = sample
+        return True
@@ -3,12 +3,24 @@ import sys
 import time
 import os
 import shutil
-import boto3
-import driver
+import hashlib
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 
+# Shared AWS clients (gas/common); progress.py needs them too, so this
+# comes before the local imports
+sys.path.insert(1, "/home/ec2-user/mpcs-cc/gas/common")
+import aws_clients
+
+import driver
+import vcf_chunks
+from progress import ProgressMonitor
+from gzip_stream import GzipStream
+
 config = ConfigParser()
-config.read("/home/ec2-user/mpcs-cc/ann/ann_config.ini")
+# GAS_ANN_CONFIG points at another config, e.g. for util/bench/bench.py
+config.read(os.environ.get('GAS_ANN_CONFIG', "/home/ec2-user/mpcs-cc/ann/ann_config.ini"))
 
 class Timer(object):
     def __init__(self, verbose=True):
@@ -27,14 +39,45 @@ class Timer(object):
 #https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_GetItem.html
 #https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
 #https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
+# Result upload settings; files upload in parallel and each large file
+# is itself sent as a parallel multipart upload
+UPLOAD_WORKERS = config.getint('ann', 'UploadWorkers', fallback=4)
+transfer_config = TransferConfig(
+    multipart_threshold=config.getint('ann', 'MultipartThresholdBytes', fallback=16 * 1024 * 1024),
+    multipart_chunksize=config.getint('ann', 'MultipartChunkSizeBytes', fallback=16 * 1024 * 1024),
+    max_concurrency=config.getint('ann', 'MaxTransferConcurrency', fallback=8),
+    use_threads=True
+)
+
+# Results of earlier jobs are reused for identical inputs annotated by the
+# same AnnTools version; leave ResultsCacheTable empty to always annotate
+RESULTS_CACHE_TABLE = config.get('ann', 'ResultsCacheTable', fallback='')
+ANNOTATOR_VERSION = config.get('ann', 'AnnotatorVersion', fallback='1')
+
+# Annotated results can be gzip-compressed while they upload
+COMPRESS_RESULTS = config.getboolean('ann', 'CompressResults', fallback=False)
+COMPRESS_LEVEL = config.getint('ann', 'CompressLevel', fallback=6)
+
 # Replace hardcoded values
-s3 = boto3.client('s3', region_name=config.get('aws', 'AwsRegionName'))
-dynamodb = boto3.resource('dynamodb')
+s3 = aws_clients.client('s3', region_name=config.get('aws', 'AwsRegionName'),
+    max_pool_connections=UPLOAD_WORKERS * transfer_config.max_request_concurrency)
+dynamodb = aws_clients.resource('dynamodb', region_name=config.get('aws', 'AwsRegionName'))
 table = dynamodb.Table(config.get('aws', 'DynamoDbTableName'))
+sns = aws_clients.client('sns', region_name=config.get('aws', 'AwsRegionName'))
 prefix = config.get('aws', 'Prefix')  # Add this line
+results_cache = dynamodb.Table(RESULTS_CACHE_TABLE) if RESULTS_CACHE_TABLE else None
+
+# Inputs at least this large are split and annotated on several cores
+CHUNK_THRESHOLD_BYTES = config.getint('ann', 'ChunkThresholdBytes', fallback=256 * 1024 * 1024)
+CHUNK_SIZE_BYTES = config.getint('ann', 'ChunkSizeBytes', fallback=64 * 1024 * 1024)
+CHUNK_WORKERS = config.getint('ann', 'ChunkWorkers', fallback=0) or os.cpu_count() or 1
+
+# Seconds between progress updates of a running job; 0 disables them
+PROGRESS_INTERVAL_SECONDS = config.getint('ann', 'ProgressIntervalSeconds', fallback=10)
 
+#https://boto3.amazonaws.com/v1/documentation/api/latest/reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
 def upload_directory_to_s3(bucket, folder_prefix, local_directory):
-    keys = []
+    uploads = []
     for root, dirs, files in os.walk(local_directory):
         for file in files:
             local_path = os.path.join(root, file)
@@ -42,9 +85,35 @@ def upload_directory_to_s3(bucket, folder_prefix, local_directory):
             relative_path = os.path.relpath(local_path, local_directory)
             # join the relative path with the folder_prefix to create the s3_path
             s3_path = os.path.join(folder_prefix, relative_path)
-            s3.upload_file(local_path, bucket, s3_path)
-            keys.append(s3_path)
-    return keys
+            compress = COMPRESS_RESULTS and file.endswith('.annot.vcf')
+            if compress:
+                s3_path += '.gz'
+            uploads.append((local_path, s3_path, compress))
+
+    total_bytes = sum(os.path.getsize(local_path) for local_path, _, _ in uploads)
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(upload_file_to_s3, local_path, bucket, s3_path, compress)
+                   for local_path, s3_path, compress in uploads]
+        # Re-raise the first failed upload, if any
+        for future in futures:
+            future.result()
+    elapsed = max(time.time() - started, 1e-6)
+    print(f"Uploaded {len(uploads)} files ({total_bytes} bytes) in {elapsed:.2f} seconds: {total_bytes / elapsed:.0f} bytes/sec")
+
+    return [s3_path for _, s3_path, _ in uploads]
+
+#https://docs.aws.amazon.com/AmazonS3/latest/API/API_PutObject.html
+def upload_file_to_s3(local_path, bucket, s3_path, compress=False):
+    if not compress:
+        s3.upload_file(local_path, bucket, s3_path, Config=transfer_config)
+        return
+
+    # Compress on the fly; Content-Encoding lets clients decode it transparently
+    with open(local_path, 'rb') as source:
+        s3.upload_fileobj(GzipStream(source, COMPRESS_LEVEL), bucket, s3_path,
+            ExtraArgs={'ContentEncoding': 'gzip', 'ContentType': 'text/plain'},
+            Config=transfer_config)
 
 
 
@@ -58,7 +127,7 @@ def update_dynamodb(job_id, results_file_val, log_file_val):
     results_bucket = config.get('aws', 'ResultsBucket')
     table.update_item(
         Key={'job_id': job_id},
-        UpdateExpression="SET s3_results_bucket = :results_bucket, s3_key_result_file = :result_file, s3_key_log_file = :log_file, complete_time = :complete_time, job_status = :status",
+        UpdateExpression="SET s3_results_bucket = :results_bucket, s3_key_result_file = :result_file, s3_key_log_file = :log_file, complete_time = :complete_time, job_status = :status REMOVE job_progress",
         ExpressionAttributeValues={
             ':results_bucket': results_bucket,
             ':result_file': results_file_val,
@@ -69,7 +138,6 @@ def update_dynamodb(job_id, results_file_val, log_file_val):
     )
 
 def send_job_complete_notification(job_id, email):
-    sns = boto3.client('sns')
     topic_arn = config.get('aws', 'JobCompleteTopic')
     message = {
         'job_id': job_id,
@@ -81,27 +149,142 @@ def send_job_complete_notification(job_id, email):
         Message=json.dumps(message)
     )
 
-if __name__ == '__main__':
-    if len(sys.argv) > 1:
-        with Timer():
-            driver.run(sys.argv[1], 'vcf')
-        job_id = sys.argv[2]
-        email = sys.argv[3]
-        file_prefix = os.path.splitext(os.path.basename(sys.argv[1]))[0]     
-        results_bucket = config.get('aws', 'ResultsBucket')
-        username = config.get('aws','Prefix')
-        folder_prefix = f'{username}/{job_id}'
-        results_file_val = f'{folder_prefix}/{file_prefix}.annot.vcf'
-        log_file_val = f'{folder_prefix}/{file_prefix}.vcf.count.log'
-
-
-        upload_directory_to_s3(results_bucket, folder_prefix, os.path.join('jobs', job_id))
-        update_dynamodb(job_id, results_file_val, log_file_val)
+def input_digest(input_file):
+    """Identify an input by its content and the AnnTools version used on it."""
+    sha256 = hashlib.sha256()
+    with open(input_file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(block)
+    return f'{sha256.hexdigest()}:{ANNOTATOR_VERSION}'
+
+#https://docs.aws.amazon.com/AmazonS3/latest/API/API_CopyObject.html
+def copy_previous_result(digest, results_file_val, log_file_val):
+    """Copy the results of an earlier job with the same input digest to this
+    job's keys. Returns the result key used, or None if there is no usable
+    earlier result (e.g. it has since been archived to Glacier)."""
+    try:
+        response = results_cache.get_item(Key={'input_digest': digest})
+    except Exception as e:
+        # The cache is best effort; annotate as if it had no entry
+        print(f"Error looking up earlier results: {e}")
+        return None
+    if 'Item' not in response:
+        return None
+    previous = response['Item']
+
+    # Keep the earlier result's encoding (and .gz suffix) along with its bytes
+    if previous['s3_key_result_file'].endswith('.gz') and not results_file_val.endswith('.gz'):
+        results_file_val += '.gz'
+    elif not previous['s3_key_result_file'].endswith('.gz') and results_file_val.endswith('.gz'):
+        results_file_val = results_file_val[:-len('.gz')]
+
+    try:
+        for source_key, key in ((previous['s3_key_result_file'], results_file_val),
+                                (previous['s3_key_log_file'], log_file_val)):
+            s3.copy({'Bucket': previous['s3_results_bucket'], 'Key': source_key},
+                config.get('aws', 'ResultsBucket'), key, Config=transfer_config)
+    except Exception as e:
+        print(f"Unable to reuse results of job {previous['job_id']}: {e}")
+        return None
+
+    print(f"Reused results of job {previous['job_id']} for identical input")
+    return results_file_val
+
+def record_result(digest, job_id, results_file_val, log_file_val):
+    try:
+        results_cache.put_item(Item={
+            'input_digest': digest,
+            'job_id': job_id,
+            's3_results_bucket': config.get('aws', 'ResultsBucket'),
+            's3_key_result_file': results_file_val,
+            's3_key_log_file': log_file_val
+        })
+    except Exception as e:
+        # Only costs a future cache hit
+        print(f"Error recording result for job {job_id}: {e}")
+
+def complete_job(job_id, email, results_file_val, log_file_val):
+    # annotator.py deletes the job request only when we finish cleanly, so
+    # any failure up to and including this update gets the job retried
+    update_dynamodb(job_id, results_file_val, log_file_val)
+    try:
         send_job_complete_notification(job_id,email)
+    except Exception as e:
+        # The job is already COMPLETED; don't have it annotated again
+        print(f"Error sending job complete notification: {e}")
+
+def run_job(input_file, job_id, email, dispatched_at=None, spool_file=None):
+    """Annotate one input file and publish its results.
+    Called once per job, either from the command line below or by a warm
+    worker process in engine.py that has already imported this module.
+    With spool_file, input_file is a named pipe that annotator.py is still
+    filling from S3 and spool_file appears once the download completed.
+    """
+    if dispatched_at is not None:
+        print(f"Startup overhead: {time.time() - dispatched_at:.2f} seconds")
+
+    file_prefix = os.path.splitext(os.path.basename(input_file))[0]     
+    results_bucket = config.get('aws', 'ResultsBucket')
+    username = config.get('aws','Prefix')
+    folder_prefix = f'{username}/{job_id}'
+    results_file_val = f'{folder_prefix}/{file_prefix}.annot.vcf'
+    if COMPRESS_RESULTS:
+        results_file_val += '.gz'
+    log_file_val = f'{folder_prefix}/{file_prefix}.vcf.count.log'
+    # Replace 'jobs' with the path to the specific directory for the completed job
+    job_directory = f'jobs/{job_id}'  
 
-        # Replace 'jobs' with the path to the specific directory for the completed job
-        job_directory = f'jobs/{job_id}'  
-        cleanup_directory(job_directory)
+    digest = None
+    if results_cache and not spool_file:
+        digest = input_digest(input_file)
+        reused_file_val = copy_previous_result(digest, results_file_val, log_file_val)
+        if reused_file_val:
+            complete_job(job_id, email, reused_file_val, log_file_val)
+            cleanup_directory(job_directory)
+            return
+
+    monitor = None
+    if PROGRESS_INTERVAL_SECONDS > 0:
+        monitor = ProgressMonitor(job_id, input_file, os.path.splitext(input_file)[0] + '.annot.vcf',
+            config.get('aws', 'DynamoDbTableName'), config.get('aws', 'AwsRegionName'),
+            PROGRESS_INTERVAL_SECONDS)
+        monitor.start()
+    try:
+        with Timer():
+            if spool_file:
+                # A pipe can only be read once, front to back
+                driver.run(input_file, 'vcf')
+            elif CHUNK_WORKERS > 1 and os.path.getsize(input_file) >= CHUNK_THRESHOLD_BYTES:
+                vcf_chunks.run_chunked(input_file, CHUNK_SIZE_BYTES, CHUNK_WORKERS)
+            else:
+                driver.run(input_file, 'vcf')
+    finally:
+        if monitor:
+            monitor.stop()
+
+    if spool_file:
+        if not os.path.exists(spool_file):
+            raise RuntimeError(f"Streamed input for job {job_id} was incomplete")
+        # Swap the pipe for the downloaded file before uploading the folder
+        os.replace(spool_file, input_file)
+        if results_cache:
+            digest = input_digest(input_file)
+
+    upload_directory_to_s3(results_bucket, folder_prefix, job_directory)
+    complete_job(job_id, email, results_file_val, log_file_val)
+    if digest:
+        record_result(digest, job_id, results_file_val, log_file_val)
+
+    cleanup_directory(job_directory)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        # annotator.py stamps the time it launched us so the interpreter and
+        # import cost shows up in the job output
+        dispatched_at = os.environ.get('GAS_DISPATCH_TIME')
+        run_job(sys.argv[1], sys.argv[2], sys.argv[3],
+            float(dispatched_at) if dispatched_at else None,
+            sys.argv[4] if len(sys.argv) > 4 else None)
 
     else:
         print("A valid .vcf file must be provided as input to this program.")
@@ -0,0 +1,94 @@
+# stream_ingest.py
+#
+# Streams a job input from S3 into the annotator while it downloads. The
+# object is fetched as parallel ranged GETs and written, in order, both to
+# a named pipe that AnnTools reads as its input file and to a spool file
+# that becomes the regular input file once the download is complete.
+#
+##
+import os
+import time
+import errno
+import fcntl
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# How long to wait for the annotator to open the pipe before giving up
+OPEN_TIMEOUT_SECONDS = 300
+
+
+#https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
+def iter_ranges(s3, bucket, key, size, etag, part_size, workers):
+    """Yield the object's bytes in order, fetching up to 2 * workers parts
+    ahead so memory stays bounded by the prefetch window."""
+    def fetch(start):
+        end = min(start + part_size, size) - 1
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end}', IfMatch=etag)
+        return response['Body'].read()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        offsets = iter(range(0, size, part_size))
+        window = deque(executor.submit(fetch, start) for _, start in zip(range(2 * workers), offsets))
+        while window:
+            data = window.popleft().result()
+            start = next(offsets, None)
+            if start is not None:
+                window.append(executor.submit(fetch, start))
+            yield data
+
+
+def open_pipe_for_writing(fifo_path, timeout=OPEN_TIMEOUT_SECONDS):
+    # A non-blocking open fails until a reader has the pipe open, which lets
+    # us give up instead of hanging if the job never starts reading
+    deadline = time.time() + timeout
+    while True:
+        try:
+            fd = os.open(fifo_path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO or time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+    return os.fdopen(fd, 'wb')
+
+
+def feed(s3, bucket, key, size, etag, fifo_path, spool_file, part_size, workers):
+    partial = spool_file + '.part'
+    try:
+        with open(partial, 'wb') as spool:
+            pipe = open_pipe_for_writing(fifo_path)
+            try:
+                for data in iter_ranges(s3, bucket, key, size, etag, part_size, workers):
+                    spool.write(data)
+                    pipe.write(data)
+                spool.close()
+                # Publish the spool file before the reader can see EOF
+                os.replace(partial, spool_file)
+            finally:
+                pipe.close()
+    except Exception as e:
+        # No spool file tells run.py the input it read was incomplete
+        print(f"Error streaming s3://{bucket}/{key}: {e}")
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def start_stream(s3, bucket, key, head, input_file, spool_file, part_size=8 * 1024 * 1024, workers=4):
+    """Create input_file as a named pipe and start filling it from S3 in the
+    background. When the stream completes, spool_file holds the whole input."""
+    # A failed earlier delivery of the job may have left its pipe or spool
+    # file behind
+    for path in (input_file, spool_file, spool_file + '.part'):
+        if os.path.lexists(path):
+            os.remove(path)
+    os.mkfifo(input_file)
+    feeder = threading.Thread(
+        target=feed,
+        args=(s3, bucket, key, head['ContentLength'], head['ETag'], input_file, spool_file, part_size, workers),
+        name=f'stream-{os.path.basename(input_file)}',
+        daemon=True)
+    feeder.start()
+    return feeder
@@ -0,0 +1,146 @@
+# vcf_chunks.py
+#
+# Annotates a large VCF file on several cores: the input is split at
+# record boundaries into chunks that each carry the full header, every
+# chunk is annotated by AnnTools in its own process, and the outputs are
+# merged back in input order into the files driver.run() would write.
+#
+##
+import os
+import re
+import shutil
+import tempfile
+import multiprocessing
+
+import driver
+
+# Size of the pieces copied between files
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# The record count line AnnTools writes to <name>.vcf.count.log is summed
+# across chunks; any other line, numbers included, is left as it is
+COUNT_LINE = re.compile(r'^(Total records processed: )(\d+)(\s*)$')
+
+
+def split_vcf(input_file, chunk_dir, chunk_size):
+    """Split input_file into chunks of roughly chunk_size bytes of records,
+    cut only at line ends, each starting with the input's header lines.
+    Returns the chunk paths in input order.
+    """
+    chunks = []
+    with open(input_file, 'rb') as vcf:
+        header = []
+        line = vcf.readline()
+        while line.startswith(b'#'):
+            header.append(line)
+            line = vcf.readline()
+
+        while line:
+            chunk_path = os.path.join(chunk_dir, f'part-{len(chunks):04d}.vcf')
+            with open(chunk_path, 'wb') as chunk:
+                chunk.writelines(header)
+                # The first record of this chunk has already been read
+                chunk.write(line)
+                remaining = chunk_size - len(line)
+                while remaining > 0:
+                    data = vcf.read(min(remaining, COPY_BUFFER_SIZE))
+                    if not data:
+                        break
+                    chunk.write(data)
+                    remaining -= len(data)
+                # Finish the record we stopped in the middle of
+                chunk.write(vcf.readline())
+            chunks.append(chunk_path)
+            line = vcf.readline()
+    return chunks
+
+
+def _annotate_chunk(chunk_path):
+    driver.run(chunk_path, 'vcf')
+
+
+def merge_annotated(chunk_outputs, output_file):
+    """Concatenate annotated chunks, keeping the header of the first one only."""
+    with open(output_file, 'wb') as merged:
+        for index, chunk_output in enumerate(chunk_outputs):
+            with open(chunk_output, 'rb') as chunk:
+                line = chunk.readline()
+                if index > 0:
+                    while line.startswith(b'#'):
+                        line = chunk.readline()
+                merged.write(line)
+                shutil.copyfileobj(chunk, merged, COPY_BUFFER_SIZE)
+
+
+def merge_count_logs(chunk_logs, output_file):
+    """Combine the per-chunk count logs into one.
+    Count lines are summed by label and written in the layout of the first
+    chunk's log; labels that only appear in later chunks follow the last
+    count line. Every other line is taken from the first chunk's log.
+    """
+    totals = {}
+    layouts = []
+    for chunk_log in chunk_logs:
+        layout = []
+        with open(chunk_log, 'r') as log:
+            for line in log:
+                line = line.rstrip('\n')
+                match = COUNT_LINE.match(line)
+                if match:
+                    label, count, trailer = match.groups()
+                    totals[label] = totals.get(label, 0) + int(count)
+                    layout.append((label, trailer))
+                else:
+                    layout.append(line)
+        layouts.append(layout)
+
+    first_layout = layouts[0]
+    seen = set(entry[0] for entry in first_layout if isinstance(entry, tuple))
+    extra = []
+    for layout in layouts[1:]:
+        for entry in layout:
+            if isinstance(entry, tuple) and entry[0] not in seen:
+                seen.add(entry[0])
+                extra.append(entry)
+
+    last_count = max([i for i, entry in enumerate(first_layout) if isinstance(entry, tuple)], default=len(first_layout) - 1)
+    lines = first_layout[:last_count + 1] + extra + first_layout[last_count + 1:]
+
+    with open(output_file, 'w') as merged:
+        for entry in lines:
+            if isinstance(entry, tuple):
+                label, trailer = entry
+                merged.write(f'{label}{totals[label]}{trailer}\n')
+            else:
+                merged.write(entry + '\n')
+
+
+def run_chunked(input_file, chunk_size, workers):
+    """Annotate input_file like driver.run(input_file, 'vcf'), using up to
+    workers processes. Chunks are written to a scratch directory next to
+    the job folder so they are never uploaded with the job's results.
+    """
+    input_file = os.path.abspath(input_file)
+    job_folder = os.path.dirname(input_file)
+    file_prefix = os.path.splitext(os.path.basename(input_file))[0]
+
+    chunk_dir = tempfile.mkdtemp(prefix=os.path.basename(job_folder) + '-chunks-', dir=os.path.dirname(job_folder))
+    try:
+        chunks = split_vcf(input_file, chunk_dir, chunk_size)
+        if len(chunks) <= 1:
+            # Nothing to gain from a process pool
+            driver.run(input_file, 'vcf')
+            return
+
+        print(f"Annotating {len(chunks)} chunks with {workers} workers")
+        with multiprocessing.get_context('fork').Pool(min(workers, len(chunks))) as pool:
+            pool.map(_annotate_chunk, chunks, chunksize=1)
+
+        merge_annotated(
+            [os.path.splitext(chunk)[0] + '.annot.vcf' for chunk in chunks],
+            os.path.join(job_folder, file_prefix + '.annot.vcf'))
+        merge_count_logs(
+            [chunk + '.count.log' for chunk in chunks],
+            input_file + '.count.log')
+    finally:
+        shutil.rmtree(chunk_dir, ignore_errors=True)
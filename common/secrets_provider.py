@@ -0,0 +1,155 @@
+# secrets_provider.py
+#
+# Secrets Manager secrets for the web app and the utilities, resolved on
+# first use and then held for the life of the process. Secrets that are
+# needed together are fetched with one BatchGetSecretValue call.
+#
+# Fetched secrets can also be kept in an encrypted file cache so restarts
+# don't wait on Secrets Manager, and so a process can still start with
+# recently cached (even expired) secrets if Secrets Manager is unavailable.
+# The cache is only used when GAS_SECRETS_CACHE_KEY holds a Fernet key and
+# the cryptography package is installed; secrets are never written in the
+# clear.
+#
+#   GAS_SECRETS_CACHE_KEY  Fernet key (Fernet.generate_key()) for the cache
+#   GAS_SECRETS_CACHE_DIR  cache directory (default ~/.cache/gas/secrets)
+#   GAS_SECRETS_CACHE_TTL  seconds a cached secret is used before it is
+#                          fetched again (default 3600)
+#
+##
+import os
+import json
+import time
+import hashlib
+import threading
+from botocore.exceptions import ClientError
+
+import aws_clients
+
+try:
+    from cryptography.fernet import Fernet, InvalidToken
+except ImportError:
+    Fernet = None
+
+CACHE_DIR = os.environ.get('GAS_SECRETS_CACHE_DIR',
+    os.path.join(os.path.expanduser('~'), '.cache', 'gas', 'secrets'))
+CACHE_TTL = int(os.environ.get('GAS_SECRETS_CACHE_TTL', 3600))
+
+# BatchGetSecretValue takes at most 20 secret IDs per call
+BATCH_SIZE = 20
+
+_lock = threading.Lock()
+_secrets = {}
+
+
+class FileCache(object):
+    """Encrypted secret values on disk, one file per secret."""
+    def __init__(self, directory, key, ttl):
+        self.directory = directory
+        self.fernet = Fernet(key)
+        self.ttl = ttl
+
+    def _path(self, secret_id):
+        return os.path.join(self.directory, hashlib.sha256(secret_id.encode()).hexdigest())
+
+    def get(self, secret_id, allow_stale=False):
+        try:
+            with open(self._path(secret_id), 'rb') as cache_file:
+                entry = json.loads(self.fernet.decrypt(cache_file.read()))
+        except (OSError, ValueError, InvalidToken):
+            return None
+        if entry['secret_id'] != secret_id:
+            return None
+        if not allow_stale and time.time() - entry['fetched_at'] > self.ttl:
+            return None
+        return entry['secret_string']
+
+    def set(self, secret_id, secret_string):
+        entry = json.dumps({'secret_id': secret_id, 'fetched_at': time.time(), 'secret_string': secret_string})
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            partial = f'{self._path(secret_id)}.{os.getpid()}'
+            fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as cache_file:
+                cache_file.write(self.fernet.encrypt(entry.encode()))
+            os.replace(partial, self._path(secret_id))
+        except OSError as e:
+            # Only costs a Secrets Manager call on the next start
+            print(f"Unable to cache secret {secret_id}: {e}")
+
+
+def _file_cache():
+    key = os.environ.get('GAS_SECRETS_CACHE_KEY')
+    if not key or Fernet is None:
+        return None
+    return FileCache(CACHE_DIR, key, CACHE_TTL)
+
+
+#https://docs.aws.amazon.com/secretsmanager/latest/apireference/API_BatchGetSecretValue.html
+def _fetch(secret_ids, region_name):
+    """Return {secret_id: SecretString} for secret_ids from Secrets Manager.
+    Secrets the batch call can't return (or all of them, if the batch call
+    itself fails, e.g. without secretsmanager:BatchGetSecretValue) are
+    fetched one at a time, so their errors are raised as usual."""
+    asm = aws_clients.client('secretsmanager', region_name=region_name)
+    fetched = {}
+    if len(secret_ids) > 1 and hasattr(asm, 'batch_get_secret_value'):
+        for start in range(0, len(secret_ids), BATCH_SIZE):
+            batch = secret_ids[start:start + BATCH_SIZE]
+            try:
+                response = asm.batch_get_secret_value(SecretIdList=batch)
+            except ClientError as e:
+                print(f"Unable to batch retrieve secrets ({e}); retrieving them one at a time")
+                break
+            for secret in response['SecretValues']:
+                # Secrets may be asked for by name or by ARN
+                secret_id = secret['Name'] if secret['Name'] in batch else secret['ARN']
+                fetched[secret_id] = secret['SecretString']
+    for secret_id in secret_ids:
+        if secret_id not in fetched:
+            fetched[secret_id] = asm.get_secret_value(SecretId=secret_id)['SecretString']
+    return fetched
+
+
+def prefetch(*secret_ids, region_name=None):
+    """Resolve secret_ids together (one batched call for all that aren't
+    cached) and return {secret_id: parsed secret}."""
+    with _lock:
+        missing = [secret_id for secret_id in secret_ids if secret_id not in _secrets]
+        if missing:
+            started = time.time()
+            cache = _file_cache()
+            loaded = {}
+            for secret_id in missing:
+                secret_string = cache.get(secret_id) if cache else None
+                if secret_string is not None:
+                    loaded[secret_id] = secret_string
+            to_fetch = [secret_id for secret_id in missing if secret_id not in loaded]
+
+            if to_fetch:
+                try:
+                    fetched = _fetch(to_fetch, region_name)
+                except Exception as e:
+                    stale = {secret_id: cache.get(secret_id, allow_stale=True) for secret_id in to_fetch} if cache else {}
+                    if None in stale.values() or not stale:
+                        raise
+                    print(f"Unable to retrieve secrets from Secrets Manager ({e}); using cached secrets")
+                    fetched = {}
+                    loaded.update(stale)
+                for secret_id, secret_string in fetched.items():
+                    if cache:
+                        cache.set(secret_id, secret_string)
+                    loaded[secret_id] = secret_string
+
+            for secret_id, secret_string in loaded.items():
+                _secrets[secret_id] = json.loads(secret_string)
+            print(f"Loaded {len(missing)} secret(s) in {time.time() - started:.2f} seconds "
+                  f"({len(missing) - len(to_fetch)} from the local cache)")
+        return {secret_id: _secrets[secret_id] for secret_id in secret_ids}
+
+
+def get_secret(secret_id, region_name=None):
+    """Return the parsed secret, fetching it on first use."""
+    return prefetch(secret_id, region_name=region_name)[secret_id]
+
+### EOF
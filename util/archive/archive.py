@@ -2,15 +2,18 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
 import sys
-import boto3
 import json
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
 from botocore.exceptions import NoCredentialsError, BotoCoreError
 
-# Import utility helpers
+# Import utility helpers and the shared AWS clients (gas/common)
 sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.realpath(os.path.join(os.path.pardir, os.path.pardir, 'common')))
 import helpers
+import aws_clients
 
 # Get configuration
 config = ConfigParser(os.environ)
@@ -28,119 +31,241 @@ ARCHIVE_QUEUE_URL = config.get('gas', 'ArchiveQueueUrl')
 PREFIX = config.get('gas', 'Prefix')
 vault = config.get('gas','GlacierName')
 AccountDatabase = config.get('gas','AccountDatabase')
+# Number of result files moved to Glacier in parallel
+ARCHIVE_THREADS = config.getint('gas', 'ArchiveThreads', fallback=10)
+# Results larger than one part are streamed to Glacier as a multipart
+# upload; the part size must be a power of two number of MiB
+GLACIER_PART_SIZE = config.getint('gas', 'GlacierPartSize', fallback=8 * 1024 * 1024)
+GLACIER_UPLOAD_THREADS = config.getint('gas', 'GlacierUploadThreads', fallback=4)
+
+
+# Shared Boto3 clients
+sqs = aws_clients.client('sqs', region_name=AWS_REGION_NAME)
+s3 = aws_clients.client('s3', region_name=AWS_REGION_NAME)
+glacier = aws_clients.client('glacier', region_name=AWS_REGION_NAME)
+
+
+#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchGetItem.html
+def get_jobs(job_ids):
+    """Fetch the annotation items for job_ids with BatchGetItem; returns a
+    dict keyed by job_id. Jobs that don't exist are left out."""
+    jobs = {}
+    if not job_ids:
+        return jobs
+    dynamodb = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME)
+    request_items = {
+        DYNAMODB_TABLE_NAME: {
+            'Keys': [{'job_id': job_id} for job_id in set(job_ids)],
+            'ProjectionExpression': 'job_id, user_id, s3_key_result_file'
+        }
+    }
+    retries = 0
+    while request_items:
+        response = dynamodb.batch_get_item(RequestItems=request_items)
+        for item in response['Responses'].get(DYNAMODB_TABLE_NAME, []):
+            jobs[item['job_id']] = item
+        request_items = response.get('UnprocessedKeys')
+        if request_items:
+            # Throttled; back off before asking for the rest
+            retries += 1
+            time.sleep(min(0.05 * 2 ** retries, 2))
+    return jobs
+
+
+#https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessageBatch.html
+def delete_messages(messages):
+    for start in range(0, len(messages), 10):
+        batch = messages[start:start + 10]
+        response = sqs.delete_message_batch(
+            QueueUrl=ARCHIVE_QUEUE_URL,
+            Entries=[{'Id': str(index), 'ReceiptHandle': message['ReceiptHandle']}
+                     for index, message in enumerate(batch)]
+        )
+        for failure in response.get('Failed', []):
+            print(f"Error deleting message from SQS queue: {failure.get('Message', failure['Code'])}")
 
 
-# Initializing Boto3 clients and resources
-sqs = boto3.client('sqs', region_name=AWS_REGION_NAME)
-dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
-s3 = boto3.client('s3', region_name=AWS_REGION_NAME)
-glacier = boto3.client('glacier', region_name=AWS_REGION_NAME)
-
-
-#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_GetItem.html
 #https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
-#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
-#https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
 #https://docs.aws.amazon.com/sns/latest/dg/sns-sqs-as-subscriber.html
-def handle_message(message):
-    sns_message = json.loads(message['Body'])
-    message_body = json.loads(sns_message['Message'])
+def handle_messages(messages):
+    """Archive the results of free users' jobs for a batch of messages.
+    Looks all jobs up with one BatchGetItem and all users with one profile
+    query, moves the result files to Glacier in parallel, and acknowledges
+    every message that needs no further work with DeleteMessageBatch.
+    Messages whose archiving failed stay in the queue to be retried.
+    Returns the number of files archived.
+    """
+    acks = []
+    job_messages = []
+    for message in messages:
+        try:
+            sns_message = json.loads(message['Body'])
+            job_messages.append((json.loads(sns_message['Message'])['job_id'], message))
+        except (ValueError, KeyError) as e:
+            print(f"Error processing message: {e}")
+            acks.append(message)
 
-    job_id = message_body['job_id']
-    
-    # Get user_id from DynamoDB using job_id
-    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
-    table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-    response = table.get_item(
-        Key={
-            'job_id': job_id
-        }
-    )
-    user_id = response['Item']['user_id']
-    
-    user_profile = helpers.get_user_profile(id=user_id, db_name=AccountDatabase)
-    user_type = user_profile[4]  # Get user_type from the user_profile list
+    try:
+        jobs = get_jobs([job_id for job_id, _ in job_messages])
+        profiles = helpers.get_user_profiles(
+            [job['user_id'] for job in jobs.values()], db_name=AccountDatabase)
+    except Exception as e:
+        # Leave the batch's messages to be delivered again
+        print(f"Error looking up jobs or user profiles: {e}")
+        if acks:
+            delete_messages(acks)
+        return 0
+
+    to_archive = []
+    for job_id, message in job_messages:
+        job = jobs.get(job_id)
+        if job is None or 's3_key_result_file' not in job:
+            # Unknown job, or its results are already archived
+            acks.append(message)
+            continue
+        profile = profiles.get(job['user_id'])
+        if profile is None:
+            print(f"No profile for user {job['user_id']} of job {job_id}; will retry")
+        elif profile['role'] == 'premium_user':
+            acks.append(message)
+        else:
+            to_archive.append((job_id, job['s3_key_result_file'], message))
 
-    if user_type != 'premium_user':
-        archive_results_file(message)
+    archived = 0
+    if to_archive:
+        with ThreadPoolExecutor(max_workers=min(ARCHIVE_THREADS, len(to_archive))) as executor:
+            futures = [(executor.submit(archive_results_file, job_id, s3_key_result_file), message)
+                       for job_id, s3_key_result_file, message in to_archive]
+            for future, message in futures:
+                if future.result():
+                    archived += 1
+                    acks.append(message)
 
-    sqs = boto3.client('sqs', region_name=AWS_REGION_NAME)
-    sqs.delete_message(
-        QueueUrl=ARCHIVE_QUEUE_URL,
-        ReceiptHandle=message['ReceiptHandle']
-    )
+    if acks:
+        delete_messages(acks)
+    return archived
+
+
+def handle_message(message):
+    handle_messages([message])
 
 
 
-#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_GetItem.html
-#https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
-#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
 #https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
-#https://docs.aws.amazon.com/sns/latest/dg/sns-sqs-as-subscriber.html
 #https://docs.aws.amazon.com/amazonglacier/latest/dev/uploading-an-archive.html
 #https://docs.aws.amazon.com/AmazonS3/latest/userguide/DeletingObjects.html
-def archive_results_file(message):
-
-    dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
+def archive_results_file(job_id, s3_key_result_file):
+    """Move one job's result file from S3 to Glacier. Returns True once the
+    archive is recorded in DynamoDB."""
+    dynamodb = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME)
     table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-    sns_message = json.loads(message['Body'])
-    message_body = json.loads(sns_message['Message'])
-
-    job_id = message_body['job_id']
-
-
-    # Get s3_key_result_file from DynamoDB using job_id
-    response = table.get_item(
-        Key={
-            'job_id': job_id
-        }
-    )
-    s3_key_result_file = response['Item']['s3_key_result_file']
 
-    s3 = boto3.client('s3', region_name=AWS_REGION_NAME)
     try:
         s3_response = s3.get_object(Bucket=RESULTS_BUCKET, Key=s3_key_result_file)
     except Exception as e:
         print(f"Error getting file from S3: {e}")
-        return
-
-    results_file = s3_response['Body'].read()
+        return False
 
-    glacier = boto3.client('glacier', region_name=AWS_REGION_NAME)
     try:
-        archive_response = glacier.upload_archive(vaultName=vault, body=results_file)
+        if s3_response['ContentLength'] <= GLACIER_PART_SIZE:
+            results_file = s3_response['Body'].read()
+            archive_response = glacier.upload_archive(vaultName=vault, body=results_file)
+            results_file_archive_id = archive_response['archiveId']
+        else:
+            results_file_archive_id = upload_archive_in_parts(s3_response['Body'], s3_response['ContentLength'])
     except Exception as e:
         print(f"Error uploading file to Glacier: {e}")
-        return
-
-    results_file_archive_id = archive_response['archiveId']
+        return False
+
+    # Compressed results are archived as-is; remember the encoding so
+    # thaw.py can restore the object exactly as it was. The size lets
+    # restore.py choose a retrieval tier
+    update_expression = 'SET results_file_archive_id = :val1, archive_status = :val2, results_file_size = :val4'
+    expression_values = {
+        ':val1': results_file_archive_id,
+        ':val2': "archived",
+        ':val4': s3_response['ContentLength']
+    }
+    if s3_response.get('ContentEncoding'):
+        update_expression += ', results_file_content_encoding = :val3'
+        expression_values[':val3'] = s3_response['ContentEncoding']
 
     try:
         table.update_item(
             Key={
                 'job_id': job_id
             },
-            UpdateExpression='SET results_file_archive_id = :val1, archive_status = :val2 REMOVE s3_key_result_file',
-            ExpressionAttributeValues={
-                ':val1': results_file_archive_id,
-                ':val2': "archived"
-            }
+            UpdateExpression=update_expression + ' REMOVE s3_key_result_file',
+            ExpressionAttributeValues=expression_values
         )
     except Exception as e:
         print(f"Error updating DynamoDB item: {e}")
-        return
+        return False
 
     try:
         s3.delete_object(Bucket=RESULTS_BUCKET, Key=s3_key_result_file)
     except Exception as e:
+        # Already archived; only the S3 copy is left behind
         print(f"Error deleting file from S3: {e}")
-        return
+
+    return True
+
+
+#https://docs.aws.amazon.com/amazonglacier/latest/dev/uploading-archive-mpu.html
+#https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+def upload_archive_in_parts(body, size):
+    """Stream an S3 object body into a Glacier multipart upload and return
+    the archive ID. Parts of GLACIER_PART_SIZE are uploaded in parallel, with
+    at most GLACIER_UPLOAD_THREADS + 1 parts in memory at a time, and the
+    archive's tree hash is built from the parts' leaf hashes as they are read.
+    """
+    upload_id = glacier.initiate_multipart_upload(
+        vaultName=vault, partSize=str(GLACIER_PART_SIZE))['uploadId']
+    in_flight = threading.BoundedSemaphore(GLACIER_UPLOAD_THREADS + 1)
+
+    def upload_part(start, data, checksum):
+        try:
+            glacier.upload_multipart_part(
+                vaultName=vault,
+                uploadId=upload_id,
+                range=f'bytes {start}-{start + len(data) - 1}/*',
+                checksum=checksum,
+                body=data)
+        finally:
+            in_flight.release()
+
+    try:
+        leaves = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=GLACIER_UPLOAD_THREADS) as executor:
+            for start in range(0, size, GLACIER_PART_SIZE):
+                in_flight.acquire()
+                data = helpers.read_part(body, min(GLACIER_PART_SIZE, size - start))
+                if len(data) != min(GLACIER_PART_SIZE, size - start):
+                    in_flight.release()
+                    raise IOError(f"Results file ended after {start + len(data)} of {size} bytes")
+                part_leaves = helpers.tree_hash_leaves(data)
+                leaves.extend(part_leaves)
+                futures.append(executor.submit(upload_part, start, data,
+                    helpers.tree_hash(part_leaves).hex()))
+                del data
+            for future in futures:
+                future.result()
+
+        return glacier.complete_multipart_upload(
+            vaultName=vault,
+            uploadId=upload_id,
+            archiveSize=str(size),
+            checksum=helpers.tree_hash(leaves).hex())['archiveId']
+    except Exception:
+        glacier.abort_multipart_upload(vaultName=vault, uploadId=upload_id)
+        raise
 
 
 #https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_ReceiveMessage.html
 def main():
-    sqs = boto3.client('sqs', region_name=AWS_REGION_NAME)
-    
+    started = time.time()
+    total_archived = 0
     while True:
         messages = sqs.receive_message(
             QueueUrl=ARCHIVE_QUEUE_URL,
@@ -149,8 +274,14 @@ def main():
         )
 
         if 'Messages' in messages:
-            for message in messages['Messages']:
-                handle_message(message)
+            batch_started = time.time()
+            archived = handle_messages(messages['Messages'])
+            total_archived += archived
+            batch_minutes = max(time.time() - batch_started, 1e-6) / 60
+            total_minutes = max(time.time() - started, 1e-6) / 60
+            print(f"Archived {archived} of {len(messages['Messages'])} messages "
+                  f"({archived / batch_minutes:.1f} archives/minute; "
+                  f"{total_archived / total_minutes:.1f} archives/minute since start)")
         else:
             print("No messages to process. Sleeping for a moment...")
             
@@ -0,0 +1,500 @@
+# bench.py
+#
+# Offline benchmark of the whole GAS job lifecycle. Annotation requests go
+# through annotator.py and run.py, then the results are archived by
+# archive.py, restored by restore.py and thawed by thaw.py, all in this
+# process. AWS is replaced by moto's in-process mocks, the accounts
+# database by SQLite, and AnnTools by the stub driver.py next to this file.
+#
+# Usage: python bench.py --jobs 200 --users 10 --slots 8 --input-bytes 1048576
+#
+# Reports jobs/second, end-to-end latency percentiles (submit to COMPLETED)
+# and the time spent in each stage. Needs boto3 and moto (pip install moto).
+#
+##
+import os
+import io
+import sys
+import json
+import time
+import uuid
+import random
+import sqlite3
+import argparse
+import tempfile
+import threading
+import importlib
+import traceback
+import contextlib
+from collections import defaultdict
+from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
+
+# Never let a benchmark talk to real AWS
+for variable, value in (('AWS_ACCESS_KEY_ID', 'testing'), ('AWS_SECRET_ACCESS_KEY', 'testing'),
+                        ('AWS_SESSION_TOKEN', 'testing'), ('AWS_DEFAULT_REGION', 'us-east-1')):
+    os.environ[variable] = value
+
+import boto3
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+UTIL_DIR = os.path.realpath(os.path.join(BENCH_DIR, os.pardir))
+GAS_DIR = os.path.realpath(os.path.join(UTIL_DIR, os.pardir))
+
+REGION = 'us-east-1'
+PREFIX = 'bench'
+INPUTS_BUCKET = 'gas-bench-inputs'
+RESULTS_BUCKET = 'gas-bench-results'
+TABLE_NAME = 'gas_bench_annotations'
+VAULT_NAME = 'gas-bench'
+
+
+class Stats(object):
+    """Durations in seconds, by stage."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.samples[stage].append(seconds)
+
+    def timed(self, module, name, stage):
+        """Replace module.name with a wrapper that records its duration.
+        GAS modules call each other through module globals, so calls from
+        inside the module are timed too."""
+        function = getattr(module, name)
+
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, time.perf_counter() - started)
+        setattr(module, name, wrapper)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * len(values))) - 1))]
+
+
+class ThreadJob(object):
+    def __init__(self):
+        self.returncode = None
+
+    def poll(self):
+        return self.returncode
+
+
+class ThreadLauncher(object):
+    """Runs run.run_job on a thread per job. Stands in for engine.py, whose
+    worker processes wouldn't share this process's mocked AWS."""
+    def __init__(self, run, on_finish):
+        self.run = run
+        self.on_finish = on_finish
+
+    def submit(self, input_file, job_id, email, spool_file=None):
+        job = ThreadJob()
+
+        def target():
+            try:
+                self.run.run_job(input_file, job_id, email, dispatched_at=time.time(), spool_file=spool_file)
+                returncode = 0
+            except Exception:
+                traceback.print_exc()
+                returncode = 1
+            self.on_finish(job_id, returncode)
+            job.returncode = returncode
+
+        threading.Thread(target=target, name=f'job-{job_id}', daemon=True).start()
+        return job
+
+    def close(self):
+        pass
+
+
+def make_vcf(size):
+    lines = ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n']
+    total = sum(len(line) for line in lines)
+    position = 10000
+    while total < size:
+        line = f"1\t{position}\t.\tA\tG\t50\tPASS\tDP=14\n"
+        lines.append(line)
+        total += len(line)
+        position += 137
+    return ''.join(lines).encode()
+
+
+def create_resources():
+    """Create the mocked buckets, table, queues, topics and vault; returns
+    the queue URLs and topic ARNs by name."""
+    s3 = boto3.client('s3', region_name=REGION)
+    for bucket in (INPUTS_BUCKET, RESULTS_BUCKET):
+        s3.create_bucket(Bucket=bucket)
+
+    boto3.client('dynamodb', region_name=REGION).create_table(
+        TableName=TABLE_NAME,
+        KeySchema=[{'AttributeName': 'job_id', 'KeyType': 'HASH'}],
+        AttributeDefinitions=[
+            {'AttributeName': 'job_id', 'AttributeType': 'S'},
+            {'AttributeName': 'user_id', 'AttributeType': 'S'},
+            {'AttributeName': 'results_file_archive_id', 'AttributeType': 'S'}
+        ],
+        GlobalSecondaryIndexes=[
+            {'IndexName': 'user_id-index',
+             'KeySchema': [{'AttributeName': 'user_id', 'KeyType': 'HASH'}],
+             'Projection': {'ProjectionType': 'ALL'}},
+            {'IndexName': 'results_file_archive_id-index',
+             'KeySchema': [{'AttributeName': 'results_file_archive_id', 'KeyType': 'HASH'}],
+             'Projection': {'ProjectionType': 'KEYS_ONLY'}}
+        ],
+        BillingMode='PAY_PER_REQUEST'
+    )
+
+    sqs = boto3.client('sqs', region_name=REGION)
+    queues = {name: sqs.create_queue(QueueName=f'gas_bench_{name}')['QueueUrl']
+              for name in ('requests', 'archive', 'restore', 'thaw')}
+    sns = boto3.client('sns', region_name=REGION)
+    topics = {name: sns.create_topic(Name=f'gas_bench_{name}')['TopicArn']
+              for name in ('job_results', 'restore')}
+    boto3.client('glacier', region_name=REGION).create_vault(vaultName=VAULT_NAME)
+    return queues, topics
+
+
+def write_ann_config(path, queues, topics):
+    config = ConfigParser()
+    config['aws'] = {
+        'AwsRegionName': REGION,
+        'QueueUrl': queues['requests'],
+        'DynamoDbTableName': TABLE_NAME,
+        'ResultsBucket': RESULTS_BUCKET,
+        'JobCompleteTopic': topics['job_results'],
+        'Prefix': PREFIX
+    }
+    config['ann'] = {
+        'ResultsCacheTable': '',
+        'InputCacheMaxBytes': '0'
+    }
+    with open(path, 'w') as config_file:
+        config.write(config_file)
+
+
+def import_from(directory, name):
+    # The utilities read their config files and find helpers.py relative
+    # to the current directory
+    cwd = os.getcwd()
+    os.chdir(directory)
+    sys.path.insert(0, directory)
+    try:
+        return importlib.import_module(name)
+    finally:
+        os.chdir(cwd)
+
+
+def install_profiles(helpers, user_ids):
+    """Serve the accounts database queries from SQLite; every user is a
+    free user, so every result gets archived."""
+    db = sqlite3.connect(':memory:', check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("CREATE TABLE profiles (identity_id TEXT PRIMARY KEY, name TEXT, email TEXT, role TEXT, institution TEXT)")
+    db.executemany("INSERT INTO profiles VALUES (?, ?, ?, 'free_user', 'GAS bench')",
+                   [(user_id, f'User {n}', f'user{n}@example.com') for n, user_id in enumerate(user_ids)])
+    lock = threading.Lock()
+
+    def get_user_profiles(ids, db_name=None):
+        ids = [str(id) for id in set(ids)]
+        if not ids:
+            return {}
+        with lock:
+            rows = db.execute(f"SELECT * FROM profiles WHERE identity_id IN ({', '.join('?' * len(ids))})", ids).fetchall()
+        return {row['identity_id']: dict(row) for row in rows}
+
+    def get_user_profile(id=None, db_name=None):
+        with lock:
+            rows = db.execute("SELECT * FROM profiles WHERE identity_id = ?", (str(id),)).fetchall()
+        return dict(rows[0]) if rows else None
+
+    helpers.get_user_profiles = get_user_profiles
+    helpers.get_user_profile = get_user_profile
+
+
+def receive(sqs, queue_url, max_messages=10):
+    return sqs.receive_message(QueueUrl=queue_url, AttributeNames=['All'], MaxNumberOfMessages=max_messages,
+                               WaitTimeSeconds=0).get('Messages', [])
+
+
+def submit_jobs(args, user_ids, queues):
+    """Create job requests the way web/views.py does; returns job_id ->
+    submit time."""
+    s3 = boto3.client('s3', region_name=REGION)
+    sqs = boto3.client('sqs', region_name=REGION)
+    table = boto3.resource('dynamodb', region_name=REGION).Table(TABLE_NAME)
+    vcf = make_vcf(args.input_bytes)
+    submitted = {}
+    for n in range(args.jobs):
+        user_id = random.choice(user_ids)
+        job_id = str(uuid.uuid4())
+        s3_key = f'{PREFIX}/{user_id}/{job_id}~input{n}.vcf'
+        s3.put_object(Bucket=INPUTS_BUCKET, Key=s3_key, Body=vcf)
+        data = {
+            'job_id': job_id,
+            'user_id': user_id,
+            'input_file_name': f'input{n}.vcf',
+            's3_inputs_bucket': INPUTS_BUCKET,
+            's3_key_input_file': s3_key,
+            'submit_time': int(time.time()),
+            'job_status': 'PENDING'
+        }
+        table.put_item(Item=data)
+        submitted[job_id] = time.time()
+        sqs.send_message(QueueUrl=queues['requests'], MessageBody=json.dumps({
+            'Type': 'Notification', 'Message': json.dumps(dict(data, email=f'{user_id}@example.com'))}))
+    return submitted
+
+
+def run_annotations(annotator, run, stats, submitted, slots):
+    """Drive annotator.py's receive/launch/reap loop until every job has
+    finished. Returns the number of failed jobs."""
+    finished = {}
+    lock = threading.Lock()
+
+    def on_finish(job_id, returncode):
+        with lock:
+            finished[job_id] = returncode
+        if returncode == 0:
+            stats.add('end_to_end', time.time() - submitted[job_id])
+
+    annotator.launcher = ThreadLauncher(run, on_finish)
+    sqs = boto3.client('sqs', region_name=REGION)
+    running = {}
+    while True:
+        annotator.reap_finished_jobs(running)
+        with lock:
+            if len(finished) == len(submitted) and not running:
+                return sum(1 for returncode in finished.values() if returncode != 0)
+        free_slots = slots - len(running)
+        messages = receive(sqs, annotator.queue_url, min(free_slots, 10)) if free_slots > 0 else []
+        for message in messages:
+            started = annotator.handle_message(message, running)
+            if started:
+                job_id, job, attempts = started
+                running[job_id] = (job, attempts)
+        if not messages:
+            time.sleep(0.01)
+
+
+def run_archive(archive, queues, job_ids):
+    sqs = boto3.client('sqs', region_name=REGION)
+    for job_id in job_ids:
+        sqs.send_message(QueueUrl=queues['archive'], MessageBody=json.dumps({
+            'Type': 'Notification', 'Message': json.dumps({'job_id': job_id})}))
+    archived = 0
+    while True:
+        messages = receive(sqs, queues['archive'])
+        if not messages:
+            return archived
+        archived += archive.handle_messages(messages)
+
+
+def run_restore(restore, queues, user_ids):
+    sqs = boto3.client('sqs', region_name=REGION)
+    for user_id in user_ids:
+        sqs.send_message(QueueUrl=queues['restore'], MessageBody=json.dumps({'user_id': user_id}))
+    while True:
+        messages = receive(sqs, queues['restore'])
+        if not messages:
+            return
+        for message in messages:
+            restore.handle_message(message)
+
+
+def wait_for_retrievals(stats, timeout):
+    """Wait for the mocked Glacier retrievals to finish and queue the
+    notifications Glacier would send through SNS. Returns the number of
+    retrievals queued."""
+    glacier = boto3.client('glacier', region_name=REGION)
+    table = boto3.resource('dynamodb', region_name=REGION).Table(TABLE_NAME)
+    items = []
+    scan_kwargs = {}
+    while True:
+        response = table.scan(**scan_kwargs)
+        items.extend(item for item in response['Items'] if 'restore_job_id' in item)
+        if 'LastEvaluatedKey' not in response:
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    notifications = []
+    started = time.time()
+    for item in items:
+        while True:
+            job = glacier.describe_job(vaultName=VAULT_NAME, jobId=item['restore_job_id'])
+            if job.get('Completed') or job.get('StatusCode') == 'Succeeded':
+                break
+            if time.time() - started > timeout:
+                raise RuntimeError(f"Glacier retrieval {item['restore_job_id']} did not finish in {timeout} seconds")
+            time.sleep(0.5)
+        notifications.append({
+            'JobId': item['restore_job_id'],
+            'ArchiveId': item['results_file_archive_id'],
+            'StatusCode': 'Succeeded',
+            'JobDescription': item['job_id'],
+            'ArchiveSizeInBytes': int(item['results_file_size'])
+        })
+    stats.add('glacier_wait', time.time() - started)
+    return notifications
+
+
+def run_thaw(thaw, queues, notifications):
+    sqs = boto3.client('sqs', region_name=REGION)
+    for notification in notifications:
+        sqs.send_message(QueueUrl=queues['thaw'], MessageBody=json.dumps({
+            'Type': 'Notification', 'Message': json.dumps(notification)}))
+    with ThreadPoolExecutor(max_workers=thaw.THAW_THREADS) as executor:
+        while True:
+            messages = receive(sqs, queues['thaw'])
+            if not messages:
+                break
+            list(executor.map(thaw.handle_message, messages))
+
+
+def report(args, driver, stats, phases, failed):
+    print(f"\n{args.jobs} jobs, {args.users} users, {args.slots} slots, {args.input_bytes} byte inputs, "
+          f"driver cost {driver.FIXED_SECONDS}s + {driver.SECONDS_PER_MB}s/MB (jitter {driver.JITTER})")
+    for phase, (count, seconds) in phases.items():
+        print(f"{phase:12} {count:6} in {seconds:8.2f} s  {count / max(seconds, 1e-9):10.2f} /s")
+    if failed:
+        print(f"{failed} annotation job(s) failed")
+
+    print(f"\n{'stage':18} {'count':>6} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9}   (ms)")
+    for stage in sorted(stats.samples, key=lambda stage: (stage != 'end_to_end', stage)):
+        values = stats.samples[stage]
+        print(f"{stage:18} {len(values):6} {1000 * sum(values) / len(values):9.1f} "
+              f"{1000 * percentile(values, 50):9.1f} {1000 * percentile(values, 95):9.1f} "
+              f"{1000 * percentile(values, 99):9.1f}")
+
+
+def benchmark(args):
+    stats = Stats()
+    queues, topics = create_resources()
+    user_ids = [str(uuid.uuid4()) for _ in range(args.users)]
+
+    workdir = tempfile.mkdtemp(prefix='gas-bench-')
+    config_path = os.path.join(workdir, 'ann_config.ini')
+    write_ann_config(config_path, queues, topics)
+    os.environ['GAS_ANN_CONFIG'] = config_path
+
+    # The stub driver must be found before AnnTools
+    sys.path.insert(0, BENCH_DIR)
+    import driver
+    if args.driver_fixed is not None:
+        driver.FIXED_SECONDS = args.driver_fixed
+    if args.driver_per_mb is not None:
+        driver.SECONDS_PER_MB = args.driver_per_mb
+    if args.driver_jitter is not None:
+        driver.JITTER = args.driver_jitter
+
+    ann_dir = os.path.join(GAS_DIR, 'ann')
+    sys.path.insert(1, os.path.join(GAS_DIR, 'common'))
+    annotator = import_from(ann_dir, 'annotator')
+    run = import_from(ann_dir, 'run')
+    run.COMPRESS_RESULTS = args.compress
+    helpers = import_from(UTIL_DIR, 'helpers')
+    install_profiles(helpers, user_ids)
+    archive = import_from(os.path.join(UTIL_DIR, 'archive'), 'archive')
+    restore = import_from(os.path.join(UTIL_DIR, 'restore'), 'restore')
+    thaw = import_from(os.path.join(UTIL_DIR, 'thaw'), 'thaw')
+
+    archive.ARCHIVE_QUEUE_URL = queues['archive']
+    archive.RESULTS_BUCKET = RESULTS_BUCKET
+    archive.DYNAMODB_TABLE_NAME = TABLE_NAME
+    archive.vault = VAULT_NAME
+    restore.RESTORE_QUEUE_URL = queues['restore']
+    restore.DYNAMODB_TABLE_NAME = TABLE_NAME
+    restore.GLACIER_VAULT = VAULT_NAME
+    restore.SNSTOPIC = topics['restore']
+    thaw.SQS_QUEUE_URL = queues['thaw']
+    thaw.RESULTS_BUCKET_NAME = RESULTS_BUCKET
+    thaw.DYNAMODB_TABLE_NAME = TABLE_NAME
+    thaw.GLACIER_VAULT = VAULT_NAME
+    # moto implements neither Glacier multipart uploads nor ranged job
+    # output, so keep every archive to a single part
+    part_size = 1024 * 1024
+    while part_size < 2 * args.input_bytes:
+        part_size *= 2
+    archive.GLACIER_PART_SIZE = max(archive.GLACIER_PART_SIZE, part_size)
+    thaw.THAW_PART_SIZE = max(thaw.THAW_PART_SIZE, part_size)
+
+    stats.timed(annotator, 'handle_message', 'dispatch')
+    stats.timed(run, 'run_job', 'run_job')
+    stats.timed(driver, 'run', 'annotate')
+    stats.timed(run, 'upload_directory_to_s3', 'upload_results')
+    stats.timed(run, 'complete_job', 'complete_job')
+    stats.timed(archive, 'archive_results_file', 'archive_file')
+    stats.timed(restore, 'restore_job', 'restore_request')
+    stats.timed(thaw, 'find_jobs', 'thaw_lookup')
+    stats.timed(thaw, 'restore_results_file', 'thaw_transfer')
+
+    phases = {}
+    os.chdir(workdir)
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with output:
+        started = time.time()
+        submitted = submit_jobs(args, user_ids, queues)
+        phases['submit'] = (len(submitted), time.time() - started)
+
+        started = time.time()
+        failed = run_annotations(annotator, run, stats, submitted, args.slots)
+        phases['annotate'] = (len(submitted) - failed, time.time() - started)
+
+        if not args.annotate_only:
+            started = time.time()
+            archived = run_archive(archive, queues, list(submitted))
+            phases['archive'] = (archived, time.time() - started)
+
+            started = time.time()
+            run_restore(restore, queues, user_ids)
+            phases['restore'] = (archived, time.time() - started)
+
+            notifications = wait_for_retrievals(stats, args.glacier_timeout)
+            started = time.time()
+            run_thaw(thaw, queues, notifications)
+            phases['thaw'] = (len(notifications), time.time() - started)
+
+    report(args, driver, stats, phases, failed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the GAS job lifecycle against mocked AWS services.')
+    parser.add_argument('--jobs', type=int, default=50, help='annotation jobs to submit')
+    parser.add_argument('--users', type=int, default=5, help='users the jobs are spread over')
+    parser.add_argument('--slots', type=int, default=4, help='jobs the annotator runs at once')
+    parser.add_argument('--input-bytes', type=int, default=256 * 1024, help='size of each input VCF')
+    parser.add_argument('--driver-fixed', type=float, help='fixed seconds per annotation')
+    parser.add_argument('--driver-per-mb', type=float, help='seconds per MB of input')
+    parser.add_argument('--driver-jitter', type=float,
+                        help='standard deviation of the annotation time, as a fraction')
+    parser.add_argument('--compress', action='store_true', help='gzip results (CompressResults)')
+    parser.add_argument('--annotate-only', action='store_true', help='skip archive, restore and thaw')
+    parser.add_argument('--glacier-timeout', type=float, default=120, help='seconds to wait for retrievals')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--verbose', action='store_true', help="show the GAS modules' output")
+    args = parser.parse_args()
+
+    if mock_aws is None:
+        sys.exit("bench.py needs moto 5 or later: pip install 'moto[all]'")
+    random.seed(args.seed)
+    with mock_aws():
+        benchmark(args)
+
+
+if __name__ == '__main__':
+    main()
+
+### EOF
@@ -0,0 +1,42 @@
+# driver.py
+#
+# Stand-in for the AnnTools driver used by bench.py. run() writes the same
+# <name>.annot.vcf and <name>.vcf.count.log files as the real annotator,
+# and takes as long as the cost model says:
+#
+#   (FIXED_SECONDS + SECONDS_PER_MB * input MB) * gauss(1, JITTER)
+#
+# The defaults can be set with the GAS_BENCH_DRIVER_* environment
+# variables, or by assigning the module attributes.
+#
+##
+import os
+import time
+import random
+
+FIXED_SECONDS = float(os.environ.get('GAS_BENCH_DRIVER_FIXED_SECONDS', 0.05))
+SECONDS_PER_MB = float(os.environ.get('GAS_BENCH_DRIVER_SECONDS_PER_MB', 0.5))
+JITTER = float(os.environ.get('GAS_BENCH_DRIVER_JITTER', 0.1))
+
+
+def run(input_file, file_type='vcf'):
+    started = time.time()
+    # A named pipe (streamed input) has no size yet; cost only what we read
+    size = 0
+    records = 0
+    base = os.path.splitext(input_file)[0]
+    with open(input_file) as vcf, open(base + '.annot.vcf', 'w') as annot:
+        for line in vcf:
+            size += len(line)
+            if not line.startswith('#'):
+                records += 1
+                line = line.rstrip('\n') + '\tBENCH\n'
+            annot.write(line)
+
+    cost = (FIXED_SECONDS + SECONDS_PER_MB * size / (1024 * 1024)) * max(0.0, random.gauss(1, JITTER))
+    remaining = cost - (time.time() - started)
+    if remaining > 0:
+        time.sleep(remaining)
+
+    with open(base + '.vcf.count.log', 'w') as log:
+        log.write(f"Total records processed: {records}\n")
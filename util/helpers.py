@@ -9,10 +9,14 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
-import boto3
+import sys
 from botocore.exceptions import ClientError
 
+# Shared AWS clients (gas/common)
+sys.path.insert(1, os.path.join(os.path.abspath(os.path.dirname(__file__)), os.pardir, 'common'))
+import aws_clients
+import secrets_provider
+
 # Get util configuration
 from configparser import SafeConfigParser
 config = SafeConfigParser(os.environ)
@@ -23,7 +27,7 @@ config.read(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'util_confi
 def send_email_ses(recipients=None, 
   sender=None, subject=None, body=None):
 
-  ses = boto3.client('ses', region_name=config['aws']['AwsRegionName'])
+  ses = aws_clients.client('ses', region_name=config['aws']['AwsRegionName'])
 
   try:
     response = ses.send_email(
@@ -41,40 +45,115 @@ def send_email_ses(recipients=None,
   return response
 
 
+import hashlib
+
+"""SHA-256 tree hashes for Amazon S3 Glacier
+https://docs.aws.amazon.com/amazonglacier/latest/dev/checksum-calculations.html
+The leaves are the hashes of each 1 MiB piece of the data; tree_hash()
+combines leaf hashes (of a part, or of a whole archive) into the root hash.
+"""
+TREE_HASH_LEAF_SIZE = 1024 * 1024
+
+def tree_hash_leaves(data):
+  leaves = [hashlib.sha256(data[offset:offset + TREE_HASH_LEAF_SIZE]).digest()
+    for offset in range(0, len(data), TREE_HASH_LEAF_SIZE)]
+  return leaves or [hashlib.sha256(b'').digest()]
+
+def tree_hash(leaves):
+  level = list(leaves)
+  while len(level) > 1:
+    level = [hashlib.sha256(level[i] + level[i + 1]).digest() if i + 1 < len(level)
+      else level[i] for i in range(0, len(level), 2)]
+  return level[0]
+
+"""Read size bytes (fewer only at the end) of a streaming body
+A streaming read may return less than asked for before the end, so parts
+and ranges read this way line up with their tree hashes.
+"""
+def read_part(body, size):
+  chunks = []
+  remaining = size
+  while remaining > 0:
+    chunk = body.read(remaining)
+    if not chunk:
+      break
+    chunks.append(chunk)
+    remaining -= len(chunk)
+  return b''.join(chunks)
+
+
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+from threading import Lock
 
-"""Access user profile in accounts database
+"""Get the accounts database credentials from AWS Secrets Manager
+Fetched on first use, once per process, through the shared secrets provider.
 """
-def get_user_profile(id=None, db_name=None):
-  # Get database connection details from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=config['aws']['AwsRegionName'])
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    raise ClientError
+def get_rds_secret():
+  return secrets_provider.get_secret('rds/accounts_database',
+    region_name=config['aws']['AwsRegionName'])
+
+"""Get the connection pool for an accounts database, creating it on first use
+"""
+def get_connection_pool(db_name=None):
+  db_name = db_name or config['gas']['AccountsDatabase']
+  with get_connection_pool.lock:
+    if db_name not in get_connection_pool.pools:
+      rds_secret = get_rds_secret()
+      get_connection_pool.pools[db_name] = psycopg2.pool.ThreadedConnectionPool(
+        int(config['gas'].get('DbPoolMinConnections', 1)),
+        int(config['gas'].get('DbPoolMaxConnections', 10)),
+        host=rds_secret['host'],
+        port=rds_secret['port'],
+        user=rds_secret['username'],
+        password=rds_secret['password'],
+        dbname=db_name)
+    return get_connection_pool.pools[db_name]
 
-  db_uri = "postgresql://" + rds_secret['username'] + ':' + \
-    rds_secret['password'] + '@' + rds_secret['host'] + ':' + \
-    str(rds_secret['port']) + '/' + \
-    (db_name or config['gas']['AccountsDatabase'])
+get_connection_pool.lock = Lock()
+get_connection_pool.pools = {}
 
+"""Run a read-only query on a pooled connection and return all rows
+"""
+def query_accounts_database(query_string, params, db_name=None):
+  pool = get_connection_pool(db_name)
+  connection = pool.getconn()
   try:
-    # Connect to accounts database and get a cursor
-    connection = psycopg2.connect(db_uri)
-    cursor = connection.cursor(cursor_factory = psycopg2.extras.DictCursor)
-    
-    # Query the database and get the user's profile record
-    query_string = f"SELECT * FROM profiles WHERE identity_id = '{id}'"
-    cursor.execute(query_string)
-    profile = cursor.fetchall()[0]
-  
-  except psycopg2.Error as e:
-    connection.rollback()
-    raise psycopg2.Error
+    with connection.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+      cursor.execute(query_string, params)
+      rows = cursor.fetchall()
+    # End the transaction so the connection goes back to the pool idle
+    connection.commit()
+    return rows
+  except psycopg2.Error:
+    if not connection.closed:
+      connection.rollback()
+    raise
+  finally:
+    # Broken connections are discarded instead of reused
+    pool.putconn(connection, close=bool(connection.closed))
+
+"""Access user profile in accounts database
+"""
+def get_user_profile(id=None, db_name=None):
+  # Query the database and get the user's profile record
+  profiles = query_accounts_database(
+    "SELECT * FROM profiles WHERE identity_id = %s", (id,), db_name)
 
   # Return user profile record as a dict
-  return profile
+  return profiles[0]
+
+"""Access the profiles of many users in one query
+Returns a dict of profile records keyed by identity_id (as a string);
+identities without a profile are left out.
+"""
+def get_user_profiles(ids, db_name=None):
+  ids = [str(id) for id in set(ids)]
+  if not ids:
+    return {}
+  profiles = query_accounts_database(
+    "SELECT * FROM profiles WHERE identity_id = ANY(%s::uuid[])", (ids,), db_name)
+  return {str(profile['identity_id']): profile for profile in profiles}
 
 ### EOF
\ No newline at end of file
@@ -3,14 +3,17 @@ import time
 import os
 import sys
 import json
-import boto3
+from concurrent.futures import ThreadPoolExecutor
 from configparser import ConfigParser
-from botocore.exceptions import NoCredentialsError, BotoCoreError
+from botocore.exceptions import NoCredentialsError, BotoCoreError, ClientError
 from boto3.dynamodb.conditions import Key
 
-# Import utility helpers
+# Import utility helpers and the shared AWS clients (gas/common)
 sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.realpath(os.path.join(os.path.pardir, os.path.pardir, 'common')))
 import helpers
+import aws_clients
+from scheduler import RestoreScheduler, TokenBucket, EXPEDITED, STANDARD
 
 # Get configuration
 config = ConfigParser(os.environ)
@@ -24,11 +27,106 @@ DYNAMODB_TABLE_NAME = config.get('gas', 'DynamoDbTableName')
 GLACIER_VAULT = config.get('gas','GlacierName')
 RESTORE_QUEUE_URL = config.get('gas', 'RestoreQueueUrl')
 SNSTOPIC = config.get('gas', 'SNSTopic')
+# Glacier retrievals started in parallel for one user
+RESTORE_THREADS = config.getint('gas', 'RestoreThreads', fallback=10)
+# Seconds after which an unfinished restore request may be made again
+RESTORE_REQUEST_TIMEOUT = config.getint('gas', 'RestoreRequestTimeout', fallback=48 * 60 * 60)
+# Retrieval tier budget: only a user's PriorityJobs most recent jobs may use
+# Expedited, only for archives up to ExpeditedMaxBytes and at most
+# ExpeditedPerHour (ExpeditedBurst at once) across all users; older jobs
+# in backlogs of BulkBacklogJobs or more use Bulk, the rest Standard
+PRIORITY_JOBS = config.getint('gas', 'PriorityJobs', fallback=5)
+EXPEDITED_MAX_BYTES = config.getint('gas', 'ExpeditedMaxBytes', fallback=250 * 1024 * 1024)
+EXPEDITED_PER_HOUR = config.getfloat('gas', 'ExpeditedPerHour', fallback=60)
+EXPEDITED_BURST = config.getint('gas', 'ExpeditedBurst', fallback=10)
+BULK_BACKLOG_JOBS = config.getint('gas', 'BulkBacklogJobs', fallback=50)
+
+# Shared Boto3 clients and resources
+sqs = aws_clients.client('sqs', region_name=AWS_REGION_NAME)
+dynamodb = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME)
+glacier = aws_clients.client('glacier', region_name=AWS_REGION_NAME)
+
+scheduler = RestoreScheduler(PRIORITY_JOBS, EXPEDITED_MAX_BYTES, BULK_BACKLOG_JOBS,
+                             TokenBucket(EXPEDITED_PER_HOUR, EXPEDITED_BURST))
+
+#https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
+def get_archived_jobs(table, user_id):
+    """Return all of the user's jobs whose results are in Glacier, reading
+    every page of the user_id index."""
+    items = []
+    query_kwargs = {
+        'IndexName': 'user_id-index',
+        'KeyConditionExpression': Key('user_id').eq(user_id)
+    }
+    while True:
+        response = table.query(**query_kwargs)
+        for item in response['Items']:
+            # Skip if 'archive_status' is not present 
+            if 'archive_status' not in item:
+                print(f"Skipping job_id: {item['job_id']}. No 'archive_status' present.")
+                continue
+            if item['archive_status'] == 'archived':
+                items.append(item)
+        if 'LastEvaluatedKey' not in response:
+            return items
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
+#https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Expressions.ConditionExpressions.html
+def restore_job(item, tier):
+    """Start a retrieval of one job's archive in the given tier, unless a
+    retrieval was already requested for it. Returns False if the retrieval
+    couldn't be started."""
+    job_id = item['job_id']
+    now = int(time.time())
+    table = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME).Table(DYNAMODB_TABLE_NAME)
+
+    # Claim the job first, so repeated subscribe messages (or a retry of
+    # this one) don't start a second retrieval while the first is running
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET restore_requested_time = :now",
+            ConditionExpression="attribute_exists(results_file_archive_id) AND "
+                                "(attribute_not_exists(restore_requested_time) OR restore_requested_time < :stale)",
+            ExpressionAttributeValues={':now': now, ':stale': now - RESTORE_REQUEST_TIMEOUT}
+        )
+    except (ClientError, BotoCoreError) as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            print(f"Restore of job_id: {job_id} already requested or complete. Skipping.")
+            if tier == EXPEDITED:
+                scheduler.expedited_bucket.give_back()
+            return True
+        print(f"Error claiming job_id: {job_id} for restore: {e}")
+        if tier == EXPEDITED:
+            scheduler.expedited_bucket.give_back()
+        return False
+
+    print(f"Archive status for job_id: {job_id} is 'archived'. Initiating {tier} restore.")
+    try:
+        restore_job_id, tier = initiate_restore(item['results_file_archive_id'], job_id, tier)
+    except Exception as e:
+        print(f"Error initiating restore of job_id: {job_id}: {e}")
+        # Release the claim so the retried message can start it
+        try:
+            table.update_item(Key={'job_id': job_id}, UpdateExpression="REMOVE restore_requested_time")
+        except (ClientError, BotoCoreError) as e:
+            # The claim lapses after RESTORE_REQUEST_TIMEOUT instead
+            print(f"Error releasing restore claim on job_id: {job_id}: {e}")
+        return False
+
+    try:
+        table.update_item(
+            Key={'job_id': job_id},
+            UpdateExpression="SET restore_job_id = :restore_job_id, restore_tier = :tier",
+            ExpressionAttributeValues={':restore_job_id': restore_job_id, ':tier': tier}
+        )
+    except (ClientError, BotoCoreError) as e:
+        # The retrieval is running either way; thaw.py finds the job by its
+        # archive and clears the claim when it completes
+        print(f"Error recording restore of job_id: {job_id}: {e}")
+    return True
 
-# Initializing Boto3 clients and resources
-sqs = boto3.client('sqs', region_name=AWS_REGION_NAME)
-dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
-glacier = boto3.client('glacier', region_name=AWS_REGION_NAME)
 
 #https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html
 #https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessage.html
@@ -40,22 +138,22 @@ def handle_message(message):
 
     # Get records from DynamoDB for the user
     table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-
-    response = table.query(
-        IndexName='user_id-index',
-        KeyConditionExpression=Key('user_id').eq(user_id)
-    )
-
-    for item in response['Items']:
-        # Skip if 'archive_status' is not present 
-        if 'archive_status' not in item:
-            print(f"Skipping job_id: {item['job_id']}. No 'archive_status' present.")
-            continue
-
-        # If status is 'archived', initiate restore
-        if item['archive_status'] == 'archived':
-            print(f"Archive status for job_id: {item['job_id']} is 'archived'. Initiating restore.")
-            initiate_restore(item['results_file_archive_id'])
+    items = get_archived_jobs(table, user_id)
+
+    # initiate_job blocks on Glacier, so start the retrievals in parallel,
+    # most recent jobs first
+    started = True
+    if items:
+        plan = scheduler.plan(items)
+        with ThreadPoolExecutor(max_workers=min(RESTORE_THREADS, len(plan))) as executor:
+            started = all(executor.map(lambda job: restore_job(*job), plan))
+        tiers = [tier for _, tier in plan]
+        print(f"Requested restore of {len(plan)} archive(s) for user {user_id}: "
+              + ", ".join(f"{tiers.count(tier)} {tier}" for tier in sorted(set(tiers))))
+
+    if not started:
+        # Leave the message for another attempt; jobs already claimed are skipped
+        return
 
     sqs.delete_message(
         QueueUrl=RESTORE_QUEUE_URL,
@@ -65,33 +163,47 @@ def handle_message(message):
 
 
 #https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html
-def initiate_restore(archive_id):
+#https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html#api-downloading-an-archive-two-steps-retrieval-options
+def initiate_restore(archive_id, annotation_job_id, tier=EXPEDITED):
+    """Start a retrieval job for archive_id; returns the Glacier job ID and
+    the tier it runs in. Expedited retrievals fall back to Standard when
+    Glacier has no Expedited capacity."""
+    # The annotation job_id goes in the Glacier job description, which comes
+    # back in the completion notification so thaw.py can look the job up
     try:
         response = glacier.initiate_job(
             vaultName=GLACIER_VAULT,
             jobParameters={
                 'Type': 'archive-retrieval',
                 'ArchiveId': archive_id,
-                'Tier': 'Expedited',
+                'Tier': tier,
+                'Description': annotation_job_id,
                 'SNSTopic': SNSTOPIC
             }
         )
         job_id = response['jobId']
-        print(f"Initiated expedited retrieval with job_id: {job_id}")
+        print(f"Initiated {tier.lower()} retrieval with job_id: {job_id}")
         
     except glacier.exceptions.InsufficientCapacityException:
+        if tier != EXPEDITED:
+            raise
+        scheduler.expedited_bucket.give_back()
+        tier = STANDARD
         response = glacier.initiate_job(
             vaultName=GLACIER_VAULT,
             jobParameters={
                 'Type': 'archive-retrieval',
                 'ArchiveId': archive_id,
-                'Tier': 'Standard',
+                'Tier': tier,
+                'Description': annotation_job_id,
                 'SNSTopic': SNSTOPIC
             }
         )
         job_id = response['jobId']
         print(f"Insufficient capacity for expedited retrieval. Initiated standard retrieval with job_id: {job_id}")
 
+    return job_id, tier
+
         
 #https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessage.html
 def main():
@@ -104,7 +216,11 @@ def main():
 
         if 'Messages' in messages:
             for message in messages['Messages']:
-                handle_message(message)
+                try:
+                    handle_message(message)
+                except Exception as e:
+                    # Leave the message to be delivered again
+                    print(f"Error handling restore request: {e}")
         else:
             print("No messages to process. Sleeping for a moment...")
 
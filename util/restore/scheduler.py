@@ -0,0 +1,75 @@
+# scheduler.py
+#
+# Chooses the Glacier retrieval tier for each archive restored for a user.
+# The user's most recent jobs, the ones most likely to be opened first, are
+# restored first and get Expedited retrievals while the Expedited budget
+# allows; large backlogs fall back to cheaper Standard and Bulk retrievals.
+#
+##
+import time
+import threading
+
+EXPEDITED = 'Expedited'
+STANDARD = 'Standard'
+BULK = 'Bulk'
+
+
+class TokenBucket(object):
+    """Allows rate_per_hour requests on average, and up to burst at once."""
+    def __init__(self, rate_per_hour, burst):
+        self.rate = rate_per_hour / 3600.0
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+    def give_back(self):
+        with self.lock:
+            self.tokens = min(self.burst, self.tokens + 1)
+
+
+class RestoreScheduler(object):
+    """
+    priority_jobs: how many of a user's most recent jobs may be Expedited
+    expedited_max_bytes: largest archive worth an Expedited retrieval
+    bulk_backlog_jobs: backlog size beyond which older jobs use Bulk
+    expedited_bucket: TokenBucket limiting Expedited retrievals overall
+    """
+    def __init__(self, priority_jobs, expedited_max_bytes, bulk_backlog_jobs, expedited_bucket):
+        self.priority_jobs = priority_jobs
+        self.expedited_max_bytes = expedited_max_bytes
+        self.bulk_backlog_jobs = bulk_backlog_jobs
+        self.expedited_bucket = expedited_bucket
+
+    def choose_tier(self, rank, size, backlog):
+        """Tier for the job at rank (0 is the most recent) of a backlog of
+        archived jobs. size is the archive size in bytes, or None if the
+        job was archived before sizes were recorded."""
+        if rank < self.priority_jobs:
+            if size is not None and size <= self.expedited_max_bytes and self.expedited_bucket.take():
+                return EXPEDITED
+            return STANDARD
+        if backlog >= self.bulk_backlog_jobs:
+            return BULK
+        return STANDARD
+
+    def plan(self, items):
+        """Return (item, tier) pairs for the archived job items, most
+        recently submitted first."""
+        items = sorted(items, key=lambda item: int(item.get('submit_time', 0)), reverse=True)
+        plan = []
+        for rank, item in enumerate(items):
+            size = item.get('results_file_size')
+            tier = self.choose_tier(rank, int(size) if size is not None else None, len(items))
+            plan.append((item, tier))
+        return plan
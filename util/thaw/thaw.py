@@ -1,13 +1,18 @@
-import boto3
 import json
-from boto3.dynamodb.conditions import Attr
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from boto3.dynamodb.conditions import Attr, Key
+from botocore.exceptions import BotoCoreError, ClientError
 from configparser import ConfigParser
 import os 
 import sys 
 
-# Import utility helpers
+# Import utility helpers and the shared AWS clients (gas/common)
 sys.path.insert(1, os.path.realpath(os.path.pardir))
+sys.path.insert(1, os.path.realpath(os.path.join(os.path.pardir, os.path.pardir, 'common')))
 import helpers
+import aws_clients
 
 # Get configuration
 config = ConfigParser(os.environ)
@@ -19,12 +24,180 @@ SQS_QUEUE_URL = config.get('gas', 'SQSQueueUrl')
 RESULTS_BUCKET_NAME = config.get('gas', 'ResultsBucket')  
 DYNAMODB_TABLE_NAME = config.get('gas', 'DynamoDbTableName')  
 GLACIER_VAULT = config.get('gas','GlacierName')
+# Global secondary index with results_file_archive_id as partition key
+ARCHIVE_ID_INDEX = config.get('gas', 'ArchiveIdIndex', fallback='results_file_archive_id-index')
+# Parallel scan segments used for items the index can't find
+SCAN_SEGMENTS = config.getint('gas', 'ScanSegments', fallback=4)
+# Restores handled at once, and the S3 part uploads running for each. The
+# part size must be a power of two number of MiB so that each range of the
+# job output has its own tree hash to check
+THAW_THREADS = config.getint('gas', 'ThawThreads', fallback=4)
+THAW_UPLOAD_THREADS = config.getint('gas', 'ThawUploadThreads', fallback=4)
+THAW_PART_SIZE = config.getint('gas', 'ThawPartSize', fallback=8 * 1024 * 1024)
+
+# Shared Boto3 clients
+s3 = aws_clients.client('s3', region_name=AWS_REGION_NAME)
+sqs = aws_clients.client('sqs', region_name=AWS_REGION_NAME)
+glacier = aws_clients.client('glacier', region_name=AWS_REGION_NAME)
+
+def consumed_units(response):
+    return response.get('ConsumedCapacity', {}).get('CapacityUnits', 0)
+
+
+#https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Scan.html#Scan.ParallelScan
+def scan_for_archive(archive_id):
+    """Paginated parallel scan for the items with archive_id. Only needed
+    for items archived before the index existed, or if it isn't there."""
+    def scan_segment(segment):
+        # Resources aren't thread-safe; use this thread's own
+        table = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME).Table(DYNAMODB_TABLE_NAME)
+        items = []
+        consumed = 0
+        scan_kwargs = {
+            'FilterExpression': Attr('results_file_archive_id').eq(archive_id),
+            'Segment': segment,
+            'TotalSegments': SCAN_SEGMENTS,
+            'ReturnConsumedCapacity': 'TOTAL'
+        }
+        while True:
+            response = table.scan(**scan_kwargs)
+            items.extend(response['Items'])
+            consumed += consumed_units(response)
+            if 'LastEvaluatedKey' not in response:
+                return items, consumed
+            scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    items = []
+    consumed = 0
+    with ThreadPoolExecutor(max_workers=SCAN_SEGMENTS) as executor:
+        for segment_items, segment_consumed in executor.map(scan_segment, range(SCAN_SEGMENTS)):
+            items.extend(segment_items)
+            consumed += segment_consumed
+    return items, consumed
+
+
+#https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/GSI.html
+#https://docs.aws.amazon.com/amazonglacier/latest/dev/api-describe-job-get.html
+def find_jobs(table, archive_id, job_description=None):
+    """Return the annotation items archived as archive_id, and the read
+    capacity units used to find them. restore.py puts the job_id in the
+    Glacier job description, so usually this is a single get_item; then the
+    archive ID index is queried, and only then is the table scanned.
+    """
+    consumed = 0
+    if job_description:
+        response = table.get_item(Key={'job_id': job_description}, ReturnConsumedCapacity='TOTAL')
+        consumed += consumed_units(response)
+        item = response.get('Item')
+        if item and item.get('results_file_archive_id') == archive_id:
+            return [item], consumed
+
+    items = []
+    query_kwargs = {
+        'IndexName': ARCHIVE_ID_INDEX,
+        'KeyConditionExpression': Key('results_file_archive_id').eq(archive_id),
+        'ReturnConsumedCapacity': 'TOTAL'
+    }
+    try:
+        while True:
+            response = table.query(**query_kwargs)
+            items.extend(response['Items'])
+            consumed += consumed_units(response)
+            if 'LastEvaluatedKey' not in response:
+                break
+            query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    except (ClientError, BotoCoreError) as e:
+        # e.g. the index hasn't been created yet; the scan still finds it
+        print(f"Error querying {ARCHIVE_ID_INDEX}: {e}")
+        items = []
+    if items:
+        # The index only projects keys; read the full items
+        full_items = []
+        for item in items:
+            response = table.get_item(Key={'job_id': item['job_id']}, ReturnConsumedCapacity='TOTAL')
+            consumed += consumed_units(response)
+            if 'Item' in response:
+                full_items.append(response['Item'])
+        return full_items, consumed
+
+    print(f"Archive {archive_id} not found in {ARCHIVE_ID_INDEX}; scanning {DYNAMODB_TABLE_NAME}")
+    items, scan_consumed = scan_for_archive(archive_id)
+    return items, consumed + scan_consumed
+
+
+#https://docs.aws.amazon.com/amazonglacier/latest/dev/api-job-output-get.html
+#https://docs.aws.amazon.com/AmazonS3/latest/userguide/mpuoverview.html
+def restore_results_file(glacier_job_id, archive_size, archive_tree_hash, s3_key_result_file, extra_args):
+    """Copy a retrieval job's output to S3 without holding the archive in
+    memory. The output is fetched in tree-hash aligned ranges of
+    THAW_PART_SIZE, each range is checked against the checksum Glacier
+    returns for it, and the ranges are uploaded as S3 multipart upload parts
+    while the next range downloads. At most THAW_UPLOAD_THREADS + 1 ranges
+    are in memory at a time.
+    """
+    def fetch(start):
+        end = min(start + THAW_PART_SIZE, archive_size) - 1
+        output = glacier.get_job_output(
+            vaultName=GLACIER_VAULT, jobId=glacier_job_id, range=f'bytes={start}-{end}')
+        data = helpers.read_part(output['body'], end - start + 1)
+        if len(data) != end - start + 1:
+            raise IOError(f"Job output ended after {start + len(data)} of {archive_size} bytes")
+        leaves = helpers.tree_hash_leaves(data)
+        checksum = output.get('checksum')
+        if checksum and helpers.tree_hash(leaves).hex() != checksum:
+            raise IOError(f"Checksum mismatch in bytes {start}-{end} of job {glacier_job_id}")
+        return data, leaves
+
+    if archive_size <= THAW_PART_SIZE:
+        data, leaves = fetch(0)
+        if archive_tree_hash and helpers.tree_hash(leaves).hex() != archive_tree_hash:
+            raise IOError(f"Checksum mismatch for job {glacier_job_id}")
+        s3.put_object(Bucket=RESULTS_BUCKET_NAME, Key=s3_key_result_file, Body=data, **extra_args)
+        return
+
+    upload_id = s3.create_multipart_upload(
+        Bucket=RESULTS_BUCKET_NAME, Key=s3_key_result_file, **extra_args)['UploadId']
+    in_flight = threading.BoundedSemaphore(THAW_UPLOAD_THREADS + 1)
+
+    def upload_part(part_number, data):
+        try:
+            response = s3.upload_part(
+                Bucket=RESULTS_BUCKET_NAME,
+                Key=s3_key_result_file,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                Body=data)
+            return {'PartNumber': part_number, 'ETag': response['ETag']}
+        finally:
+            in_flight.release()
+
+    try:
+        all_leaves = []
+        futures = []
+        with ThreadPoolExecutor(max_workers=THAW_UPLOAD_THREADS) as executor:
+            for part_number, start in enumerate(range(0, archive_size, THAW_PART_SIZE), 1):
+                in_flight.acquire()
+                try:
+                    data, leaves = fetch(start)
+                except Exception:
+                    in_flight.release()
+                    raise
+                all_leaves.extend(leaves)
+                futures.append(executor.submit(upload_part, part_number, data))
+                del data
+            parts = [future.result() for future in futures]
+
+        if archive_tree_hash and helpers.tree_hash(all_leaves).hex() != archive_tree_hash:
+            raise IOError(f"Checksum mismatch for job {glacier_job_id}")
+        s3.complete_multipart_upload(
+            Bucket=RESULTS_BUCKET_NAME,
+            Key=s3_key_result_file,
+            UploadId=upload_id,
+            MultipartUpload={'Parts': parts})
+    except Exception:
+        s3.abort_multipart_upload(Bucket=RESULTS_BUCKET_NAME, Key=s3_key_result_file, UploadId=upload_id)
+        raise
 
-# Initialize Boto3 clients and resources
-s3 = boto3.client('s3', region_name=AWS_REGION_NAME)
-sqs = boto3.client('sqs', region_name=AWS_REGION_NAME)
-glacier = boto3.client('glacier', region_name=AWS_REGION_NAME)
-dynamodb = boto3.resource('dynamodb', region_name=AWS_REGION_NAME)
 
 #https://docs.aws.amazon.com/amazonglacier/latest/dev/downloading-an-archive-two-steps.html
 #https://aws.amazon.com/cn/sns/faqs/
@@ -36,30 +209,38 @@ def handle_message(message):
         message_content = json.loads(message['Body'])  
         message_body = json.loads(message_content['Message'])  
 
-        job_id = message_body['JobId']
+        glacier_job_id = message_body['JobId']
         archive_id = message_body['ArchiveId']
         job_status = message_body['StatusCode']
+        job_description = message_body.get('JobDescription')
+        archive_size = message_body.get('ArchiveSizeInBytes')
+        archive_tree_hash = message_body.get('ArchiveSHA256TreeHash')
     except Exception as e:
         print(f"Error processing message: {e}")
         return
 
     if job_status == "Succeeded":
         try:
-            output = glacier.get_job_output(vaultName=GLACIER_VAULT, jobId=job_id)
-            file_data = output['body'].read()
+            if archive_size is None:
+                job = glacier.describe_job(vaultName=GLACIER_VAULT, jobId=glacier_job_id)
+                archive_size = job['ArchiveSizeInBytes']
+                archive_tree_hash = job.get('ArchiveSHA256TreeHash')
         except Exception as e:
-            print(f"Error retrieving Glacier job output: {e}")
+            print(f"Error describing Glacier job: {e}")
             return
 
         try:
+            # Resources aren't thread-safe; use this thread's own
+            dynamodb = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME)
             table = dynamodb.Table(DYNAMODB_TABLE_NAME)
-            response = table.scan(FilterExpression=Attr('results_file_archive_id').eq(archive_id))
+            items, consumed = find_jobs(table, archive_id, job_description)
+            print(f"Found {len(items)} job(s) for archive {archive_id} using {consumed} read capacity units")
         except Exception as e:
-            print(f"Error scanning DynamoDB table: {e}")
+            print(f"Error finding archived job in DynamoDB: {e}")
             return
 
-        if 'Items' in response:
-            for item in response['Items']:
+        if items:
+            for item in items:
                 try:
                    
                     user_id = item['user_id']
@@ -69,10 +250,21 @@ def handle_message(message):
                     # form the s3_key_result_file name
                     s3_key_result_file = s3_key_log_file.replace('.vcf.count.log', '.annot.vcf')
 
-                    # Puts the file back up to S3 with the s3_key_result_file name
-                    s3.put_object(Bucket=RESULTS_BUCKET_NAME, Key=s3_key_result_file, Body=file_data)
+                    # Compressed results were archived as-is; restore them with
+                    # the same key suffix and Content-Encoding
+                    extra_args = {}
+                    content_encoding = item.get('results_file_content_encoding')
+                    if content_encoding == 'gzip':
+                        s3_key_result_file += '.gz'
+                        extra_args = {'ContentEncoding': content_encoding, 'ContentType': 'text/plain'}
+
+                    # Streams the file back up to S3 with the s3_key_result_file name
+                    started = time.time()
+                    restore_results_file(glacier_job_id, int(archive_size), archive_tree_hash,
+                                         s3_key_result_file, extra_args)
+                    print(f"Restored {archive_size} bytes of job {job_id} in {time.time() - started:.1f} seconds")
                 except Exception as e:
-                    print(f"Error uploading to S3: {e}")
+                    print(f"Error restoring results file to S3: {e}")
                     continue
 
                 try:
@@ -80,7 +272,7 @@ def handle_message(message):
                     # and add the s3_key_results_file field.
                     table.update_item(
                         Key={'job_id': job_id},
-                        UpdateExpression="SET s3_key_result_file = :val1 REMOVE results_file_archive_id, archive_status",
+                        UpdateExpression="SET s3_key_result_file = :val1 REMOVE results_file_archive_id, archive_status, results_file_content_encoding, restore_requested_time, restore_job_id, restore_tier",
                         ExpressionAttributeValues={':val1': s3_key_result_file}
                     )
                 except Exception as e:
@@ -98,7 +290,27 @@ def handle_message(message):
                     continue
 
     elif job_status == "Failed":
-        print(f"Job {job_id} failed.")
+        print(f"Job {glacier_job_id} failed.")
+        # Release the restore claim so the job can be restored again without
+        # waiting for RestoreRequestTimeout
+        try:
+            dynamodb = aws_clients.resource('dynamodb', region_name=AWS_REGION_NAME)
+            table = dynamodb.Table(DYNAMODB_TABLE_NAME)
+            items, _ = find_jobs(table, archive_id, job_description)
+        except Exception as e:
+            print(f"Error finding archived job in DynamoDB: {e}")
+            return
+        for item in items:
+            try:
+                # Leave a newer retrieval of the same job alone
+                table.update_item(
+                    Key={'job_id': item['job_id']},
+                    UpdateExpression="REMOVE restore_requested_time, restore_job_id, restore_tier",
+                    ConditionExpression="attribute_not_exists(restore_job_id) OR restore_job_id = :glacier_job_id",
+                    ExpressionAttributeValues={':glacier_job_id': glacier_job_id}
+                )
+            except Exception as e:
+                print(f"Error releasing restore claim on job {item['job_id']}: {e}")
 
     try:
         # Deletes the message from the queue.
@@ -111,23 +323,33 @@ def handle_message(message):
 
 #https://docs.aws.amazon.com/AWSSimpleQueueService/latest/APIReference/API_DeleteMessage.html
 def main():
-    while True:
-        try:
-            messages = sqs.receive_message(
-                QueueUrl=SQS_QUEUE_URL,
-                MaxNumberOfMessages=10,  
-                WaitTimeSeconds=5  # Enable long polling
-            )
-        except Exception as e:
-            print(f"Error receiving messages from SQS queue: {e}")
-            continue
+    # Restores run concurrently; only ask for as many messages as there are
+    # free threads so received messages don't wait out their visibility timeout
+    running = set()
+    with ThreadPoolExecutor(max_workers=THAW_THREADS) as executor:
+        while True:
+            running = {future for future in running if not future.done()}
+            free_threads = THAW_THREADS - len(running)
+            if free_threads == 0:
+                wait(running, return_when=FIRST_COMPLETED)
+                continue
+
+            try:
+                messages = sqs.receive_message(
+                    QueueUrl=SQS_QUEUE_URL,
+                    MaxNumberOfMessages=min(free_threads, 10),
+                    WaitTimeSeconds=5  # Enable long polling
+                )
+            except Exception as e:
+                print(f"Error receiving messages from SQS queue: {e}")
+                continue
 
-        if 'Messages' in messages:
-            for message in messages['Messages']:
-                handle_message(message)
+            if 'Messages' in messages:
+                for message in messages['Messages']:
+                    running.add(executor.submit(handle_message, message))
 
-        else:
-            print("No messages to process. Sleeping for a moment...")
+            else:
+                print("No messages to process. Sleeping for a moment...")
 
 if __name__ == '__main__':
     main()
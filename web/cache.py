@@ -0,0 +1,110 @@
+# cache.py
+#
+# Key/value cache backends for the GAS web app
+#
+##
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+"""In-process cache with per-entry TTL and least recently used eviction
+Values are kept as-is, so callers should store plain data.
+"""
+class MemoryCache(object):
+  def __init__(self, ttl=300, max_entries=10000):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.entries = OrderedDict()
+    self.lock = Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      expires_at, value = entry
+      if expires_at < time.time():
+        del self.entries[key]
+        return None
+      self.entries.move_to_end(key)
+      return value
+
+  def set(self, key, value):
+    with self.lock:
+      self.entries[key] = (time.time() + self.ttl, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+  def delete(self, key):
+    with self.lock:
+      self.entries.pop(key, None)
+
+
+"""Redis-backed cache shared by all web server processes
+Values must be JSON-serializable. Redis errors are treated as cache
+misses so the app keeps working (uncached) if Redis is unavailable.
+"""
+class RedisCache(object):
+  def __init__(self, url, ttl=300, prefix='gas:'):
+    # Optional dependency; only needed when this backend is configured
+    import redis
+    self.redis = redis
+    self.client = redis.Redis.from_url(url)
+    self.ttl = ttl
+    self.prefix = prefix
+
+  def get(self, key):
+    try:
+      value = self.client.get(self.prefix + key)
+    except self.redis.RedisError:
+      return None
+    return json.loads(value) if value is not None else None
+
+  def set(self, key, value):
+    try:
+      self.client.set(self.prefix + key, json.dumps(value), ex=self.ttl)
+    except self.redis.RedisError:
+      pass
+
+  def delete(self, key):
+    try:
+      self.client.delete(self.prefix + key)
+    except self.redis.RedisError:
+      pass
+
+"""In-process least recently used cache of byte strings, bounded by their
+total size rather than by the number of entries. Values larger than
+max_entry_bytes are not cached.
+"""
+class BytesCache(object):
+  def __init__(self, max_bytes=32 * 1024 * 1024, max_entry_bytes=1024 * 1024):
+    self.max_bytes = max_bytes
+    self.max_entry_bytes = max_entry_bytes
+    self.entries = OrderedDict()
+    self.size = 0
+    self.lock = Lock()
+
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None:
+        self.entries.move_to_end(key)
+      return entry
+
+  def set(self, key, value, data):
+    """Cache data (bytes) along with value, e.g. its ETag"""
+    if len(data) > self.max_entry_bytes:
+      return
+    with self.lock:
+      old = self.entries.pop(key, None)
+      if old is not None:
+        self.size -= len(old[1])
+      self.entries[key] = (value, data)
+      self.size += len(data)
+      while self.size > self.max_bytes:
+        _, (_, evicted) = self.entries.popitem(last=False)
+        self.size -= len(evicted)
+
+### EOF
@@ -9,14 +9,20 @@
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
 import os
-import json
-import boto3
+import sys
+import time
 import base64
-from botocore.exceptions import ClientError
+
+# Shared secrets provider (gas/common)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import secrets_provider
 
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config(object):
+  # Config is loaded first; views.py logs the time to the first request
+  GAS_STARTED_AT = time.time()
+
   GAS_LOG_LEVEL = os.environ['GAS_LOG_LEVEL'] \
     if ('GAS_LOG_LEVEL' in os.environ) else 'INFO'
   GAS_LOG_FILE_PATH = basedir + (os.environ['GAS_LOG_FILE_PATH'] \
@@ -37,26 +43,22 @@ class Config(object):
   AWS_REGION_NAME = os.environ['AWS_REGION_NAME'] \
     if ('AWS_REGION_NAME' in  os.environ) else "us-east-1"
 
-  # Get various credentials from AWS Secrets Manager
-  asm = boto3.client('secretsmanager', region_name=AWS_REGION_NAME)
-
-  # Get Flask application secret
+  # Get the Flask, RDS and Globus Auth secrets from AWS Secrets Manager in
+  # one batched call, or from the encrypted local cache if one is set up
   try:
-    asm_response = asm.get_secret_value(SecretId='gas/web_server')
-    flask_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Flask secret from ASM: {e}")
+    secrets = secrets_provider.prefetch('gas/web_server', 'rds/accounts_database',
+      'globus/auth_client', region_name=AWS_REGION_NAME)
+  except Exception as e:
+    print(f"Unable to retrieve secrets from ASM: {e}")
     raise e
-  SECRET_KEY = flask_secret['flask_secret_key']
+  flask_secret = secrets['gas/web_server']
+  rds_secret = secrets['rds/accounts_database']
+  globus_auth = secrets['globus/auth_client']
 
-  # Get RDS secret and construct database URI
-  try:
-    asm_response = asm.get_secret_value(SecretId='rds/accounts_database')
-    rds_secret = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve accounts database credentials from ASM: {e}")
-    raise e
+  # Get Flask application secret
+  SECRET_KEY = flask_secret['flask_secret_key']
 
+  # Construct database URI
   SQLALCHEMY_DATABASE_TABLE = os.environ['ACCOUNTS_DATABASE_TABLE']
   SQLALCHEMY_DATABASE_URI = "postgresql://" + \
     rds_secret['username'] + ':' + rds_secret['password'] + \
@@ -64,14 +66,6 @@ class Config(object):
     '/' + SQLALCHEMY_DATABASE_TABLE
   SQLALCHEMY_TRACK_MODIFICATIONS = True
 
-  # Get the Globus Auth client ID and secret
-  try:
-    asm_response = asm.get_secret_value(SecretId='globus/auth_client')
-    globus_auth = json.loads(asm_response['SecretString'])
-  except ClientError as e:
-    print(f"Unable to retrieve Globus Auth credentials from ASM: {e}")
-    raise e
-
   # Set the Globus Auth client ID and secret
   GAS_CLIENT_ID = globus_auth['gas_client_id']
   GAS_CLIENT_SECRET = globus_auth['gas_client_secret']
@@ -79,6 +73,8 @@ class Config(object):
 
   # Set validity of pre-signed POST requests (in seconds)
   AWS_SIGNED_REQUEST_EXPIRATION = 60
+  # Batch uploads can take much longer to get through
+  AWS_SIGNED_BATCH_REQUEST_EXPIRATION = 3600
 
   AWS_S3_INPUTS_BUCKET = "mpcs-cc-gas-inputs"
   AWS_S3_RESULTS_BUCKET = "mpcs-cc-gas-results"
@@ -101,10 +97,42 @@ class Config(object):
 
   # Change the table name to your own
   AWS_DYNAMODB_ANNOTATIONS_TABLE = "tianyushi_annotations"
+  # Index with user_id as partition key and submit_time as sort key
+  AWS_DYNAMODB_USER_JOBS_INDEX = "user_id-submit_time-index"
+
+  # Threads that save and publish submitted jobs concurrently
+  JOB_SUBMIT_THREADS = 16
+
+  # Most jobs that can be submitted in one batch request
+  BATCH_SUBMIT_MAX_JOBS = 500
+
+  # Number of jobs per page of the annotations list
+  ANNOTATIONS_PAGE_SIZE = 25
 
   # Change the email address to your username
   MAIL_DEFAULT_SENDER = "tianyushi@mpcs-cc.com"
 
+  # User profile cache; "memory" is per process, "redis" is shared by all
+  # web server processes (needs the redis package)
+  PROFILE_CACHE_BACKEND = os.environ['PROFILE_CACHE_BACKEND'] \
+    if ('PROFILE_CACHE_BACKEND' in os.environ) else "memory"
+  PROFILE_CACHE_REDIS_URL = os.environ['PROFILE_CACHE_REDIS_URL'] \
+    if ('PROFILE_CACHE_REDIS_URL' in os.environ) else "redis://localhost:6379/0"
+  PROFILE_CACHE_TTL = 60
+  PROFILE_CACHE_MAX_ENTRIES = 10000
+
+  # The log page shows the last LOG_TAIL_BYTES of the log; logs of up to
+  # LOG_CACHE_MAX_ENTRY_BYTES are cached in memory, LOG_CACHE_MAX_BYTES in all
+  LOG_TAIL_BYTES = 64 * 1024
+  LOG_CHUNK_BYTES = 64 * 1024
+  LOG_CACHE_MAX_BYTES = 32 * 1024 * 1024
+  LOG_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+
+  # Job progress: seconds between checks of a running job, and how long an
+  # (opt-in) event stream stays open; each open stream holds a worker
+  PROGRESS_POLL_SECONDS = 3
+  PROGRESS_STREAM_SECONDS = 300
+
   # Time before free user results are archived (in seconds)
   FREE_USER_DATA_RETENTION = 300
 
@@ -11,8 +11,7 @@ __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 from flask import redirect, request, session, url_for
 from functools import wraps
 
-from gas import db
-from models import Profile
+from profile_cache import get_profile
 
 """Mark a route as requiring authentication
 """
@@ -39,7 +38,7 @@ def is_premium(fn):
   @wraps(fn)
   def decorated_function(*args, **kwargs):
     # Check if user is a subscriber
-    profile = db.session.query(Profile).filter_by(identity_id=session.get('primary_identity')).first()
+    profile = get_profile(identity_id=session.get('primary_identity'))
     if not profile:
       # Force login
       return redirect(url_for('login', next=request.url))
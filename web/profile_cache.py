@@ -0,0 +1,58 @@
+# profile_cache.py
+#
+# Read-through cache of user profiles in front of the accounts database
+#
+##
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from gas import app, db
+from models import Profile
+from cache import MemoryCache, RedisCache
+
+"""Snapshot of the Profile columns the app reads
+Cached instead of the ORM object, which is tied to a database session.
+"""
+CachedProfile = namedtuple('CachedProfile',
+  ['identity_id', 'name', 'email', 'institution', 'role'])
+
+if app.config['PROFILE_CACHE_BACKEND'] == 'redis':
+  profiles = RedisCache(app.config['PROFILE_CACHE_REDIS_URL'],
+    ttl=app.config['PROFILE_CACHE_TTL'], prefix='gas:profile:')
+else:
+  profiles = MemoryCache(ttl=app.config['PROFILE_CACHE_TTL'],
+    max_entries=app.config['PROFILE_CACHE_MAX_ENTRIES'])
+
+"""Get a user profile, from the cache if possible
+Returns None if the user has no profile yet; those misses aren't cached.
+"""
+def get_profile(identity_id=None):
+  key = str(identity_id)
+  fields = profiles.get(key)
+  if fields is None:
+    profile = db.session.query(Profile).filter_by(identity_id=identity_id).first()
+    if not profile:
+      return None
+    fields = {
+      'identity_id': str(profile.identity_id),
+      'name': profile.name,
+      'email': profile.email,
+      'institution': profile.institution,
+      'role': profile.role
+    }
+    profiles.set(key, fields)
+  return CachedProfile(**fields)
+
+"""Drop a user's cached profile after it changed
+"""
+def invalidate_profile(identity_id=None):
+  profiles.delete(str(identity_id))
+
+"""Invalidate on every profile update, including auth.update_profile()
+"""
+@event.listens_for(Profile, 'after_update')
+def profile_updated(mapper, connection, target):
+  invalidate_profile(target.identity_id)
+
+### EOF
@@ -8,22 +8,81 @@
 ##
 __author__ = 'Vas Vasiliadis <vas@uchicago.edu>'
 
+import os
+import sys
 import uuid
 import time
 import json
+import base64
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
-import boto3
 from boto3.dynamodb.conditions import Key
-from botocore.client import Config
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 
-from flask import (abort, flash, redirect, render_template,
-  request, session, url_for)
+from flask import (abort, flash, jsonify, redirect, render_template,
+  request, session, stream_with_context, url_for, Response)
 
 from gas import app, db
 from decorators import authenticated, is_premium
-from auth import get_profile, update_profile
+from auth import update_profile
+from profile_cache import get_profile, invalidate_profile
+from cache import BytesCache
+
+# Shared AWS clients (gas/common)
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'common'))
+import aws_clients
+
+# Runs the DynamoDB writes and SNS publishes of job submissions concurrently
+submit_executor = ThreadPoolExecutor(max_workers=app.config['JOB_SUBMIT_THREADS'])
+
+# Recently viewed log files, which never change once written
+log_cache = BytesCache(max_bytes=app.config['LOG_CACHE_MAX_BYTES'],
+  max_entry_bytes=app.config['LOG_CACHE_MAX_ENTRY_BYTES'])
+
+
+"""Log how long after startup this process served its first request
+"""
+@app.before_request
+def log_first_request():
+  if not getattr(log_first_request, 'done', False):
+    log_first_request.done = True
+    app.logger.info(f"First request {time.time() - app.config['GAS_STARTED_AT']:.2f} "
+      f"seconds after config import")
+
+
+"""Presign an S3 POST for uploading one input file of user_id's
+The success field tells S3 where to send the browser (success_action_redirect)
+or which status to return (success_action_status) after the upload.
+"""
+def presign_input_upload(s3, user_id, success_field, success_value,
+  expires_in=None):
+  # Generate unique ID to be used as S3 key (name)
+  key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
+    str(uuid.uuid4()) + '~${filename}'
+
+  # Define policy fields/conditions
+  encryption = app.config['AWS_S3_ENCRYPTION']
+  acl = app.config['AWS_S3_ACL']
+  fields = {
+    success_field: success_value,
+    "x-amz-server-side-encryption": encryption,
+    "acl": acl
+  }
+  conditions = [
+    ["starts-with", "$" + success_field, success_value]
+      if success_field == "success_action_redirect" else {success_field: success_value},
+    {"x-amz-server-side-encryption": encryption},
+    {"acl": acl}
+  ]
+
+  return s3.generate_presigned_post(
+    Bucket=app.config['AWS_S3_INPUTS_BUCKET'],
+    Key=key_name,
+    Fields=fields,
+    Conditions=conditions,
+    ExpiresIn=expires_in or app.config['AWS_SIGNED_REQUEST_EXPIRATION'])
 
 
 """Start annotation request
@@ -40,43 +99,17 @@ but you can replace the code below with your own if you prefer.
 @authenticated
 def annotate():
   # Create a session client to the S3 service
-  s3 = boto3.client('s3',
-    region_name=app.config['AWS_REGION_NAME'],
-    config=Config(signature_version='s3v4'))
+  s3 = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
 
-  bucket_name = app.config['AWS_S3_INPUTS_BUCKET']
   global user_id
   user_id = session['primary_identity']
 
-  # Generate unique ID to be used as S3 key (name)
-  key_name = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/' + \
-    str(uuid.uuid4()) + '~${filename}'
-
   # Create the redirect URL
   redirect_url = str(request.url) + '/job'
 
-  # Define policy fields/conditions
-  encryption = app.config['AWS_S3_ENCRYPTION']
-  acl = app.config['AWS_S3_ACL']
-  fields = {
-    "success_action_redirect": redirect_url,
-    "x-amz-server-side-encryption": encryption,
-    "acl": acl
-  }
-  conditions = [
-    ["starts-with", "$success_action_redirect", redirect_url],
-    {"x-amz-server-side-encryption": encryption},
-    {"acl": acl}
-  ]
-
   # Generate the presigned POST call
   try:
-    presigned_post = s3.generate_presigned_post(
-      Bucket=bucket_name, 
-      Key=key_name,
-      Fields=fields,
-      Conditions=conditions,
-      ExpiresIn=app.config['AWS_SIGNED_REQUEST_EXPIRATION'])
+    presigned_post = presign_input_upload(s3, user_id, "success_action_redirect", redirect_url)
   except ClientError as e:
     app.logger.error(f"Unable to generate presigned URL for upload: {e}")
     return abort(500)
@@ -85,6 +118,72 @@ def annotate():
   return render_template('annotate.html', s3_post=presigned_post)
 
 
+"""Save a new job item to the annotations table
+Runs on submit_executor, so it uses that thread's own DynamoDB resource.
+Never overwrites an existing job (e.g. when the upload redirect is
+reloaded), so its status and results are never reset. Returns the job's
+status: PENDING for a new job, or whatever status the existing job has;
+a job still PENDING may never have been published.
+"""
+def save_job(data):
+  dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  try:
+    table.put_item(Item=data, ConditionExpression='attribute_not_exists(job_id)')
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+      raise
+    response = table.get_item(Key={'job_id': data['job_id']},
+      ProjectionExpression='job_status', ConsistentRead=True)
+    return response.get('Item', {}).get('job_status')
+  return data['job_status']
+
+"""Save many new job items with BatchWriteItem
+The batch writer sends 25 items per call and resends unprocessed items.
+"""
+def save_jobs(items):
+  dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+  with table.batch_writer() as batch:
+    for item in items:
+      batch.put_item(Item=item)
+
+"""Return which of job_ids already have a job item, with BatchGetItem
+"""
+#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchGetItem.html
+def existing_job_ids(job_ids):
+  dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table_name = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
+  existing = set()
+  # BatchGetItem reads at most 100 keys per call
+  for start in range(0, len(job_ids), 100):
+    request_items = {table_name: {
+      'Keys': [{'job_id': job_id} for job_id in job_ids[start:start + 100]],
+      'ProjectionExpression': 'job_id'}}
+    retries = 0
+    while request_items:
+      response = dynamo.batch_get_item(RequestItems=request_items)
+      existing.update(item['job_id'] for item in response['Responses'].get(table_name, []))
+      request_items = response.get('UnprocessedKeys')
+      if request_items:
+        # Throttled; back off before asking for the rest
+        retries += 1
+        time.sleep(min(0.05 * 2 ** retries, 2))
+  return existing
+
+"""Check that an input file was uploaded
+"""
+def input_uploaded(bucket, key):
+  s3 = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  try:
+    s3.head_object(Bucket=bucket, Key=key)
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('404', '403', 'NoSuchKey'):
+      return False
+    raise
+  return True
+
+
 """Fires off an annotation job
 Accepts the S3 redirect GET request, parses it to extract 
 required info, saves a job item to the database, and then
@@ -112,8 +211,6 @@ def create_annotation_job_request():
   # Extract the input file name from the S3 key
   input_file_name = s3_key.split('/')[-1].split('~')[-1]  
   submit_time = int(time.time())
-  profile = get_profile(user_id)
-  user_email = profile.email
 
   data = {
         "job_id": job_id,
@@ -125,29 +222,193 @@ def create_annotation_job_request():
         "job_status": "PENDING"
     }
 
-  # Set up DynamoDB connection
-  dynamo = boto3.resource('dynamodb')
-  tablename= app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
-  table = dynamo.Table(tablename)
-  # Save the data to the database
-  response = table.put_item(Item=data)
+  # Save the job to the database while the user's profile is looked up
+  saved = submit_executor.submit(save_job, data)
 
-  current_time = int(time.time() * 1000)
-  message_deduplication_id = f"{data['job_id']}_{current_time}"
+  profile = get_profile(user_id)
+  data_with_email = data.copy()  # create a copy of data so we don't modify the original
+  data_with_email['email'] = profile.email
 
-  session = boto3.Session()
-  s3 = session.client('s3', region_name='us-east-1') 
-  sns = boto3.client('sns')
+  if saved.result() != 'PENDING':
+    # A repeated redirect for a job that is already running or done
+    return render_template('annotate_confirm.html', job_id=job_id)
 
-  data_with_email = data.copy()  # create a copy of data so we don't modify the original
-  data_with_email['email'] = user_email
-  sns_response = sns.publish(TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'], Message=json.dumps(data_with_email), MessageGroupId = 'jobs_status', MessageDeduplicationId=message_deduplication_id)
+  sns = aws_clients.client('sns', region_name=app.config['AWS_REGION_NAME'])
+  # Publish a PENDING job again on a repeated redirect, in case an earlier
+  # attempt saved it but failed before publishing; deduplicating on job_id
+  # drops the repeat if the earlier publish did go through
+  sns.publish(
+    TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'], Message=json.dumps(data_with_email),
+    MessageGroupId='jobs_status', MessageDeduplicationId=job_id)
 
   return render_template('annotate_confirm.html', job_id=job_id)
 
+"""Start a batch of annotation requests
+Takes JSON {"count": N} and returns N presigned S3 POSTs, one per input
+file. Each upload answers with HTTP 201 rather than a redirect, so
+scripts can upload all the files and then register them at once with
+/annotate/batch/jobs.
+"""
+@app.route('/annotate/batch', methods=['POST'])
+@authenticated
+def annotate_batch():
+  body = request.get_json(silent=True) or {}
+  count = body.get('count')
+  if not isinstance(count, int) or not 1 <= count <= app.config['BATCH_SUBMIT_MAX_JOBS']:
+    return jsonify(error=f"count must be between 1 and {app.config['BATCH_SUBMIT_MAX_JOBS']}"), 400
+
+  s3 = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  user_id = session['primary_identity']
+  try:
+    uploads = [presign_input_upload(s3, user_id, "success_action_status", "201",
+        app.config['AWS_SIGNED_BATCH_REQUEST_EXPIRATION']) for _ in range(count)]
+  except ClientError as e:
+    app.logger.error(f"Unable to generate presigned URLs for batch upload: {e}")
+    return abort(500)
+
+  return jsonify(uploads=uploads)
+
+
+"""Register a batch of uploaded input files as annotation jobs
+Takes JSON {"keys": [...]} with the S3 keys of files uploaded through
+/annotate/batch. Saves all the job items with BatchWriteItem while the
+requests are published with PublishBatch, ten per call, and returns the
+job IDs that were submitted and the keys that weren't. Keys that weren't
+uploaded are rejected, and keys already registered are returned as
+already_submitted without touching their jobs.
+"""
+#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_BatchWriteItem.html
+#https://docs.aws.amazon.com/sns/latest/api/API_PublishBatch.html
+@app.route('/annotate/batch/jobs', methods=['POST'])
+@authenticated
+def create_annotation_job_batch():
+  body = request.get_json(silent=True) or {}
+  keys = body.get('keys')
+  if not isinstance(keys, list) or not 1 <= len(keys) <= app.config['BATCH_SUBMIT_MAX_JOBS']:
+    return jsonify(error=f"keys must list 1 to {app.config['BATCH_SUBMIT_MAX_JOBS']} S3 keys"), 400
+
+  user_id = session['primary_identity']
+  user_prefix = app.config['AWS_S3_KEY_PREFIX'] + user_id + '/'
+  submit_time = int(time.time())
+  jobs = {}
+  rejected = []
+  for s3_key in keys:
+    # Only keys of the form <prefix><user_id>/<job_id>~<file name>
+    job_id, _, input_file_name = str(s3_key)[len(user_prefix):].partition('~')
+    try:
+      uuid.UUID(job_id)
+    except ValueError:
+      job_id = None
+    if not str(s3_key).startswith(user_prefix) or not job_id or not input_file_name:
+      rejected.append(s3_key)
+      continue
+    jobs[job_id] = {
+      "job_id": job_id,
+      "user_id": user_id,
+      "input_file_name": input_file_name,
+      "s3_inputs_bucket": app.config['AWS_S3_INPUTS_BUCKET'],
+      "s3_key_input_file": s3_key,
+      "submit_time": submit_time,
+      "job_status": "PENDING"
+    }
+
+  if not jobs:
+    return jsonify(submitted=[], rejected=rejected), 400
+
+  # Look for the uploads and for jobs registered before, all at once
+  bucket = app.config['AWS_S3_INPUTS_BUCKET']
+  found = {job_id: submit_executor.submit(input_uploaded, bucket, job['s3_key_input_file'])
+    for job_id, job in jobs.items()}
+  already_submitted = sorted(existing_job_ids(list(jobs)))
+  for job_id in already_submitted:
+    del jobs[job_id]
+  for job_id in list(jobs):
+    if not found[job_id].result():
+      rejected.append(jobs.pop(job_id)['s3_key_input_file'])
+
+  if not jobs:
+    return jsonify(submitted=[], already_submitted=already_submitted, rejected=rejected), \
+      200 if already_submitted else 400
+
+  # Save the jobs and publish the requests at the same time, as for single
+  # jobs; the annotator retries a request that arrives before its job item
+  saved = submit_executor.submit(save_jobs, list(jobs.values()))
+
+  profile = get_profile(user_id)
+  sns = aws_clients.client('sns', region_name=app.config['AWS_REGION_NAME'])
+  entries = [{
+    'Id': str(index),
+    'Message': json.dumps(dict(job, email=profile.email)),
+    'MessageGroupId': 'jobs_status',
+    'MessageDeduplicationId': job['job_id']
+  } for index, job in enumerate(jobs.values())]
+  published = [submit_executor.submit(sns.publish_batch,
+      TopicArn=app.config['AWS_SNS_JOB_REQUEST_TOPIC'],
+      PublishBatchRequestEntries=entries[start:start + 10])
+    for start in range(0, len(entries), 10)]
+
+  saved.result()
+  job_ids = list(jobs)
+  failed = set()
+  for start, future in zip(range(0, len(job_ids), 10), published):
+    try:
+      response = future.result()
+    except (ClientError, BotoCoreError) as e:
+      # None of this call's requests were published
+      app.logger.error(f"Unable to publish job requests: {e}")
+      failed.update(job_ids[start:start + 10])
+      continue
+    for failure in response.get('Failed', []):
+      app.logger.error(f"Unable to publish job request: {failure.get('Message', failure['Code'])}")
+      failed.add(job_ids[int(failure['Id'])])
+
+  # Remove the items of jobs that weren't published so their keys can be
+  # registered again
+  if failed:
+    dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+    table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
+    for job_id in failed:
+      try:
+        table.delete_item(Key={'job_id': job_id}, ConditionExpression='job_status = :pending',
+          ExpressionAttributeValues={':pending': 'PENDING'})
+      except (ClientError, BotoCoreError) as e:
+        app.logger.error(f"Unable to remove unpublished job {job_id}: {e}")
+
+  return jsonify(
+    submitted=[job_id for job_id in job_ids if job_id not in failed],
+    already_submitted=already_submitted,
+    rejected=rejected + [jobs[job_id]['s3_key_input_file'] for job_id in job_ids if job_id in failed])
+
+
+"""Opaque pagination cursors for DynamoDB queries
+The cursor is the query's LastEvaluatedKey, serialized as URL-safe base64
+JSON; numeric key attributes (e.g. submit_time) are integers.
+"""
+def encode_cursor(last_evaluated_key):
+  key = {name: (int(value) if isinstance(value, Decimal) else value)
+    for name, value in last_evaluated_key.items()}
+  return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(cursor):
+  key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+  if not isinstance(key, dict):
+    raise ValueError("Invalid cursor")
+  return key
+
+
+"""Format a Unix timestamp for display
+"""
+@app.template_filter('timestamp')
+def format_timestamp(value):
+  if not value:
+    return None
+  return datetime.fromtimestamp(int(value)).strftime('%Y-%m-%d %H:%M:%S')
+
+
 #https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
+#https://docs.aws.amazon.com/amazondynamodb/latest/developerguide/Query.Pagination.html
 #AUTH TOOL 
-"""List all annotations for the user
+"""List the user's annotations, newest first, one page at a time
 """
 @app.route('/annotations', methods=['GET'])
 @authenticated
@@ -156,28 +417,39 @@ def annotations_list():
     user_id = session['primary_identity']
 
     # Set up DynamoDB connection
-    dynamo = boto3.resource('dynamodb')
+    dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
     tablename = app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE']
     table = dynamo.Table(tablename)
 
-    # Query DynamoDB for jobs submitted by the current user
-    response = table.query(
-        KeyConditionExpression=Key('user_id').eq(user_id),
-        IndexName='user_id-index'
-    )
+    # Query one page of the user's jobs, newest first (submit_time is the
+    # index sort key), fetching only the columns the list shows
+    query = {
+        'IndexName': app.config['AWS_DYNAMODB_USER_JOBS_INDEX'],
+        'KeyConditionExpression': Key('user_id').eq(user_id),
+        'ScanIndexForward': False,
+        'Limit': app.config['ANNOTATIONS_PAGE_SIZE'],
+        'ProjectionExpression': 'job_id, submit_time, input_file_name, job_status'
+    }
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            query['ExclusiveStartKey'] = decode_cursor(cursor)
+        except ValueError:
+            abort(400)
+        # A cursor can only continue the current user's own listing
+        if query['ExclusiveStartKey'].get('user_id') != user_id:
+            abort(400)
+
+    response = table.query(**query)
 
     # Get list of annotations to display
     annotations = response['Items']
+    next_cursor = None
+    if 'LastEvaluatedKey' in response:
+        next_cursor = encode_cursor(response['LastEvaluatedKey'])
 
-    # Convert Unix timestamps to human-readable format
-    for annotation in annotations:
-        annotation['submit_time'] = datetime.fromtimestamp(int(annotation['submit_time'])).strftime('%Y-%m-%d %H:%M:%S')
-        if 'complete_time' in annotation and annotation['complete_time']:
-            annotation['complete_time'] = datetime.fromtimestamp(int(annotation['complete_time'])).strftime('%Y-%m-%d %H:%M:%S')
-        else:
-            annotation['complete_time'] = None
-
-    return render_template('annotations.html', annotations=annotations)
+    return render_template('annotations.html', annotations=annotations,
+        next_cursor=next_cursor, is_first_page=not cursor)
 
 
 #https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_GetItem.html
@@ -188,7 +460,7 @@ def annotation_details(id):
     # Get current user id
     current_user_id = session.get('primary_identity')
 
-    dynamo = boto3.resource('dynamodb', region_name='us-east-1')
+    dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
     table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
     profile = get_profile(identity_id=current_user_id)
     user_role = profile.role
@@ -215,12 +487,18 @@ def annotation_details(id):
         job['complete_time'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(job['complete_time']))
     
 
-    s3_client = boto3.client('s3', region_name='us-east-1')
+    s3_client = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
 
     # Check if 's3_key_result_file' exists
     if 's3_key_result_file' in job:
  
-        result_file_url = s3_client.generate_presigned_url('get_object', Params={'Bucket': app.config['AWS_S3_RESULTS_BUCKET'], 'Key': job['s3_key_result_file']}, ExpiresIn=3600)
+        params = {'Bucket': app.config['AWS_S3_RESULTS_BUCKET'], 'Key': job['s3_key_result_file']}
+        # Compressed results are served with Content-Encoding: gzip, so the
+        # browser decodes them; save under the uncompressed file name
+        if job['s3_key_result_file'].endswith('.gz'):
+          file_name = job['s3_key_result_file'].split('/')[-1][:-len('.gz')]
+          params['ResponseContentDisposition'] = f'attachment; filename="{file_name}"'
+        result_file_url = s3_client.generate_presigned_url('get_object', Params=params, ExpiresIn=3600)
         job['result_file_url'] = result_file_url
     else:
         if user_role == "free_user":
@@ -232,52 +510,222 @@ def annotation_details(id):
 
 
 
-"""Display the log file contents for an annotation job
+"""Get a job item the current user is allowed to see
+Returns (job, None), or (None, error response) if the job doesn't exist or
+belongs to someone else. With projection (which must include user_id), only
+those attributes are read.
 """
-#https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
-#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
-#AUTH TOOL 
-@app.route('/annotations/<id>/log', methods=['GET'])
-@authenticated
-def annotation_log(id):
-  # Get current user id
-  current_user_id = session.get('primary_identity')
-
-  # Set up DynamoDB connection
-  dynamo = boto3.resource('dynamodb', region_name='us-east-1')
+def get_user_job(id, projection=None):
+  dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
   table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
-
-  # Get the job details
-  response = table.get_item(
-      Key={
-          'job_id': id
-      }
-  )
+  if projection:
+    response = table.get_item(Key={'job_id': id}, ProjectionExpression=projection)
+  else:
+    response = table.get_item(Key={'job_id': id})
 
   # If the job doesn't exist
   if 'Item' not in response:
-    return render_template('error.html', error_message='Job not found'), 404
+    return None, (render_template('error.html', error_message='Job not found'), 404)
 
   job = response['Item']
 
   # Check if the current user is authorized to view the job
-  if job['user_id'] != current_user_id:
-    return render_template('error.html', error_message='Not authorized to view this job'), 403
+  if job['user_id'] != session.get('primary_identity'):
+    return None, (render_template('error.html', error_message='Not authorized to view this job'), 403)
+
+  return job, None
+
+
+"""Read part of a job's log file
+byte_range is an HTTP Range value (e.g. "bytes=-65536" for the tail). Logs
+are written once, when the job completes, so small ones are kept in
+log_cache and served again without calling S3. Returns (etag, size of the
+whole log, chunks of the requested part); chunks is None if the browser's
+copy (if_none_match) is current.
+"""
+def read_log(key, byte_range=None, if_none_match=None):
+  cached = log_cache.get(key)
+  if cached:
+    etag, data = cached
+    if if_none_match == etag:
+      return etag, len(data), None
+    start, end = parse_byte_range(byte_range, len(data))
+    return etag, len(data), iter([data[start:end]])
+
+  s3 = aws_clients.client('s3', region_name=app.config['AWS_REGION_NAME'])
+  params = {'Bucket': app.config['AWS_S3_RESULTS_BUCKET'], 'Key': key}
+  if byte_range:
+    params['Range'] = byte_range
+  if if_none_match:
+    params['IfNoneMatch'] = if_none_match
+  try:
+    response = s3.get_object(**params)
+  except ClientError as e:
+    if e.response['Error']['Code'] in ('304', 'NotModified'):
+      return if_none_match, None, None
+    raise
+
+  etag = response['ETag']
+  size = response['ContentLength']
+  if 'ContentRange' in response:
+    size = int(response['ContentRange'].rsplit('/', 1)[-1])
+
+  if size == response['ContentLength'] and size <= log_cache.max_entry_bytes:
+    # The whole log came back; keep it for the next view
+    data = response['Body'].read()
+    log_cache.set(key, etag, data)
+    return etag, size, iter([data])
+
+  def chunks():
+    try:
+      for chunk in response['Body'].iter_chunks(app.config['LOG_CHUNK_BYTES']):
+        yield chunk
+    finally:
+      response['Body'].close()
+  return etag, size, chunks()
+
+
+"""Resolve an HTTP byte range ("bytes=start-", "bytes=start-end" or
+"bytes=-suffix") against a body of size bytes; returns a slice
+"""
+def parse_byte_range(byte_range, size):
+  if not byte_range:
+    return 0, size
+  first, _, last = byte_range[len('bytes='):].partition('-')
+  if not first:
+    return max(0, size - int(last)), size
+  return int(first), min(size, int(last) + 1) if last else size
+
+
+"""Display the log file contents for an annotation job
+Only the last LOG_TAIL_BYTES are shown; the whole log is streamed by
+annotation_log_file.
+"""
+#https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
+#https://docs.aws.amazon.com/amazondynamodb/latest/APIReference/API_Query.html
+#AUTH TOOL 
+@app.route('/annotations/<id>/log', methods=['GET'])
+@authenticated
+def annotation_log(id):
+  job, error = get_user_job(id)
+  if error:
+    return error
 
-  # Fetch log file from S3
-  s3 = boto3.client('s3')
+  # Fetch the tail of the log file from S3
+  tail_bytes = app.config['LOG_TAIL_BYTES']
+  try:
+    _, log_size, chunks = read_log(job['s3_key_log_file'], f'bytes=-{tail_bytes}')
+  except ClientError as e:
+    if e.response['Error']['Code'] != 'InvalidRange':
+      app.logger.error(f"Unable to retrieve log file: {e}")
+      return abort(500)
+    # The log is empty
+    log_size, chunks = 0, []
+
+  log_file_content = b''.join(chunks).decode('utf-8', errors='replace')
+  truncated = log_size > tail_bytes
+  if truncated:
+    # Drop the partial first line
+    log_file_content = log_file_content.partition('\n')[2]
+
+  return render_template('view_log.html', job_id=id, log_file_contents=log_file_content,
+    truncated=truncated, log_size=log_size)
+
+
+"""Stream an annotation job's log file
+Query parameters: offset=N returns the log from byte N on (e.g. to follow a
+log from where the last request ended), tail=N returns its last N bytes;
+without either the whole log is returned. X-Log-Size gives the size of the
+whole log. The response carries the log's ETag, and requests with a
+matching If-None-Match get 304 Not Modified.
+"""
+#https://docs.aws.amazon.com/AmazonS3/latest/API/API_GetObject.html
+#https://flask.palletsprojects.com/en/2.3.x/patterns/streaming/
+@app.route('/annotations/<id>/log/file', methods=['GET'])
+@authenticated
+def annotation_log_file(id):
+  job, error = get_user_job(id)
+  if error:
+    return error
+
+  offset = request.args.get('offset', type=int)
+  tail = request.args.get('tail', type=int)
+  if (offset is not None and offset < 0) or (tail is not None and tail <= 0):
+    return abort(400)
+  byte_range = f'bytes={offset}-' if offset is not None else \
+    (f'bytes=-{tail}' if tail is not None else None)
+
+  if_none_match = request.headers.get('If-None-Match')
   try:
-    log_file = s3.get_object(Bucket=app.config['AWS_S3_RESULTS_BUCKET'], Key=job['s3_key_log_file'])
+    etag, log_size, chunks = read_log(job['s3_key_log_file'], byte_range, if_none_match)
   except ClientError as e:
+    if e.response['Error']['Code'] == 'InvalidRange':
+      # Nothing past offset (yet), or the log is empty (a tail request)
+      return Response(b'', mimetype='text/plain',
+        headers={'X-Log-Size': str(offset if offset is not None else 0)})
     app.logger.error(f"Unable to retrieve log file: {e}")
     return abort(500)
-  
-  log_file_content = log_file['Body'].read().decode('utf-8')
 
-  return render_template('view_log.html', job_id=id, log_file_contents=log_file_content)
+  headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+  if chunks is None:
+    return Response(status=304, headers=headers)
+  headers['X-Log-Size'] = str(log_size)
+  return Response(stream_with_context(chunks), mimetype='text/plain', headers=headers)
+
+
+"""Read a job's status and progress with one small get_item
+"""
+def read_progress(table, id):
+  response = table.get_item(Key={'job_id': id}, ProjectionExpression='job_status, job_progress')
+  return progress_state(response.get('Item', {}))
+
+def progress_state(job):
+  progress = {name: int(value) for name, value in job.get('job_progress', {}).items()}
+  return {'job_status': job.get('job_status'), 'progress': progress}
 
 
+"""Report a job's status and progress
+Returns JSON by default; the details page polls it every
+PROGRESS_POLL_SECONDS. Clients that ask for Accept: text/event-stream get
+the state as server-sent events whenever it changes, until the job
+completes or fails or PROGRESS_STREAM_SECONDS have passed. Each open
+stream holds a gunicorn worker, so the page itself doesn't use them.
+"""
+#https://developer.mozilla.org/en-US/docs/Web/API/Server-sent_events/Using_server-sent_events
+@app.route('/annotations/<id>/progress', methods=['GET'])
+@authenticated
+def annotation_progress(id):
+  # Polled every few seconds, so read only what the response needs
+  # (eventually consistent, like every read here)
+  job, error = get_user_job(id, 'user_id, job_status, job_progress')
+  if error:
+    return error
+  state = progress_state(job)
+
+  if 'text/event-stream' not in request.headers.get('Accept', ''):
+    return jsonify(state)
+
+  dynamo = aws_clients.resource('dynamodb', region_name=app.config['AWS_REGION_NAME'])
+  table = dynamo.Table(app.config['AWS_DYNAMODB_ANNOTATIONS_TABLE'])
 
+  def events(state):
+    deadline = time.time() + app.config['PROGRESS_STREAM_SECONDS']
+    yield f"retry: {app.config['PROGRESS_POLL_SECONDS'] * 1000}\n\n"
+    last = None
+    while True:
+      if state != last:
+        yield f"data: {json.dumps(state)}\n\n"
+        last = state
+      else:
+        # Keeps proxies from closing an idle connection
+        yield ": waiting\n\n"
+      if state['job_status'] in ('COMPLETED', 'FAILED') or time.time() > deadline:
+        return
+      time.sleep(app.config['PROGRESS_POLL_SECONDS'])
+      state = read_progress(table, id)
+
+  return Response(stream_with_context(events(state)), mimetype='text/event-stream',
+    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 
 #AUTH TOOL 
@@ -300,13 +748,14 @@ def subscribe():
       identity_id=session['primary_identity'],
       role="premium_user"
     )
+    invalidate_profile(session['primary_identity'])
 
     # Update role in the session
     session['role'] = "premium_user"
 
-    # Initialize boto3 client for SQS
+    # Get the shared SQS client
     AWS_REGION_NAME = app.config['AWS_REGION_NAME']
-    sqs = boto3.client('sqs', region_name=AWS_REGION_NAME)
+    sqs = aws_clients.client('sqs', region_name=AWS_REGION_NAME)
     queue_url = app.config['AWS_SQS_RESTORE']
 
     # Prepare message body
@@ -334,6 +783,7 @@ def unsubscribe():
     identity_id=session['primary_identity'],
     role="free_user"
   )
+  invalidate_profile(session['primary_identity'])
   return redirect(url_for('profile'))
 
 